@@ -0,0 +1,59 @@
+# per request type body decoding cost, old orjson + global cattr.structure path vs
+# decode_request, which uses precompiled hooks for some types. run from the repo root:
+#   python -m bench.request_decoding
+from timeit import repeat
+
+from cattr import structure
+from orjson import dumps, loads
+
+import src.user.handlers  # noqa: F401, registers the precompiled hooks and limits
+from src.user.decoding import decode_request
+from src.user.handlers.auth import AuthenticateRequest, CreateAccountRequest
+from src.user.handlers.models.feed import (
+    CreateCommentRequest,
+    CreatePostRequest,
+    UploadImageRequest,
+)
+from src.user.handlers.user import UpdateProfileRequest
+
+NUMBER = 20000
+
+BODIES = {
+    AuthenticateRequest: {"username": "user1", "password": "hunter2" * 4},
+    CreateAccountRequest: {
+        "username": "new.user_1",
+        "password": "hunter2" * 4,
+        "email": "new.user@example.com",
+    },
+    CreatePostRequest: {"text": "x" * 280},
+    CreateCommentRequest: {"text": "y" * 150},
+    UpdateProfileRequest: {
+        "bio": "bio " * 40,
+        "display_name": "User One",
+        "header_image_url": "ab/cd/abcdefghijklmnop.png",
+    },
+    UploadImageRequest: {"image_type": "png"},
+}
+
+
+def old_path(body: bytes, cl_type: type):
+    # what request.json(loads=loads) followed by cattr.structure did
+    return structure(loads(body), cl_type)
+
+
+def best_us(fn, body: bytes, cl_type: type) -> float:
+    return (
+        min(repeat(lambda: fn(body, cl_type), number=NUMBER, repeat=5)) / NUMBER * 1e6
+    )
+
+
+if __name__ == "__main__":
+    print(f"{'request':<24}{'before us':>12}{'after us':>12}{'speedup':>10}")
+    for cl_type, data in BODIES.items():
+        body = dumps(data)
+        assert old_path(body, cl_type) == decode_request(body, cl_type)
+        before = best_us(old_path, body, cl_type)
+        after = best_us(decode_request, body, cl_type)
+        print(
+            f"{cl_type.__name__:<24}{before:>12.2f}{after:>12.2f}{before / after:>9.1f}x"
+        )
@@ -0,0 +1,82 @@
+# per-endpoint response serialization cost, old cattr + stdlib json path vs the
+# precompiled converter + orjson path. run from the repo root:
+#   python -m bench.serialization
+from json import dumps as std_dumps
+from timeit import repeat
+
+from cattr import unstructure
+
+import src.user.handlers  # noqa: F401, registers the precompiled hooks
+from src.user.db_feed import Post
+from src.user.db_user import Account, Profile
+from src.user.handlers.models.feed import Comment
+from src.user.models import APIResponse, ProfileSummary
+from src.user.serialization import encode
+
+NUMBER = 2000
+
+
+def make_post(i: int) -> Post:
+    return Post(
+        i,
+        i % 50,
+        1690000000 + i,
+        "x" * 280,
+        i % 7,
+        i * 3,
+        0,
+        i % 2 == 0,
+        f"user{i % 50}",
+    )
+
+
+PAYLOADS = {
+    "/user/{id}": lambda: APIResponse(
+        {"user": Account(1, "user1", "$2b$12$" + "x" * 53, "user1@example.com")}
+    ),
+    "/profile/{username}": lambda: APIResponse(
+        {"profile": Profile(1, "user1", "bio " * 40, "ab/cd/header.png", 120, 4500)}
+    ),
+    "/post/{id}": lambda: APIResponse({"post": make_post(1)}),
+    "/user/{id}/posts (10)": lambda: APIResponse(
+        {"posts": [make_post(i) for i in range(10)], "next_cursor": "MTY5MDAwMDAwOToy"}
+    ),
+    "/user/{id}/posts (50)": lambda: APIResponse(
+        {"posts": [make_post(i) for i in range(50)], "next_cursor": "MTY5MDAwMDAwOToy"}
+    ),
+    "/post/{id}/comments (50)": lambda: APIResponse(
+        {
+            "comments": [
+                Comment(
+                    i,
+                    ProfileSummary(i % 20, f"user{i % 20}"),
+                    "y" * 150,
+                    1690000000 + i,
+                )
+                for i in range(50)
+            ],
+            "next_cursor": None,
+        }
+    ),
+}
+
+
+def old_path(resp: APIResponse) -> bytes:
+    # what aiohttp.json_response did with the unstructured dict
+    return std_dumps(unstructure(resp)).encode("utf-8")
+
+
+def best_us(fn, payload) -> float:
+    return min(repeat(lambda: fn(payload), number=NUMBER, repeat=5)) / NUMBER * 1e6
+
+
+if __name__ == "__main__":
+    print(f"{'endpoint':<28}{'before us':>12}{'after us':>12}{'speedup':>10}")
+    for name, make_payload in PAYLOADS.items():
+        payload = make_payload()
+        assert std_dumps(
+            unstructure(payload), separators=(",", ":")
+        ).encode() == encode(payload)
+        before = best_us(old_path, payload)
+        after = best_us(encode, payload)
+        print(f"{name:<28}{before:>12.1f}{after:>12.1f}{before / after:>9.1f}x")
@@ -0,0 +1,83 @@
+# username and email validators vs the regexes that define them. fuzzes both for
+# disagreements, then times adversarial inputs. run from the repo root:
+#   python -m bench.validators
+from random import Random
+from re import fullmatch
+from timeit import repeat
+
+from src.user.util import EMAIL_REGEX, USERNAME_REGEX, email_matches, username_matches
+
+FUZZ_CASES = 200_000
+NUMBER = 200
+
+# pieces random inputs are built from, every character either language treats
+# specially plus some it doesn't. common ones are repeated so that a fair share
+# of the inputs is valid
+USERNAME_ALPHABET = [*"aZ9 ;*.!_-#@\n١", "a", "Z9", "a!", "a.*"]
+EMAIL_ALPHABET = [*".@-!~_A \n١", "a", "z9", "a.", "a-b", "a@b.c"]
+
+
+def fuzz(name: str, matches, regex, alphabet: list[str], max_pieces: int, rng: Random):
+    valid = 0
+    for _ in range(FUZZ_CASES):
+        value = "".join(rng.choices(alphabet, k=rng.randint(0, max_pieces)))
+        expected = fullmatch(regex, value) is not None
+        assert matches(value) == expected, (name, value, expected)
+        valid += expected
+    print(f"{name}: {FUZZ_CASES} inputs, {valid} valid, no mismatches")
+
+
+# name -> (validator, regex, input of about n chars, lengths to time the regex at)
+# the validators are also timed at about 1000 chars, the backtracking username
+# regex would take years at that length
+ADVERSARIAL = {
+    # each run of "!" can be split between separators and body in many ways
+    "username a!!!..!#": (
+        username_matches,
+        USERNAME_REGEX,
+        lambda n: "a" + "!" * n + "#",
+        (8, 16, 24, 30),
+    ),
+    "username a.*.*..#": (
+        username_matches,
+        USERNAME_REGEX,
+        lambda n: "a" + ".*" * (n // 2) + "#",
+        (8, 16, 24, 30),
+    ),
+    "email a@a.a.a...-": (
+        email_matches,
+        EMAIL_REGEX,
+        lambda n: "a@" + "a." * (n // 2) + "-",
+        (16, 64, 252),
+    ),
+    "email a@aaaa...!": (
+        email_matches,
+        EMAIL_REGEX,
+        lambda n: "a@" + "a" * n + "!",
+        (16, 64, 252),
+    ),
+}
+
+
+def best_us(fn, number: int) -> float:
+    return min(repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+if __name__ == "__main__":
+    rng = Random(0)
+    fuzz("username", username_matches, USERNAME_REGEX, USERNAME_ALPHABET, 8, rng)
+    fuzz("email", email_matches, EMAIL_REGEX, EMAIL_ALPHABET, 8, rng)
+    print()
+
+    print(f"{'input':<22}{'length':>8}{'regex us':>14}{'validator us':>14}")
+    for name, (matches, regex, make_input, regex_lengths) in ADVERSARIAL.items():
+        for n in sorted({*regex_lengths, 1024}):
+            value = make_input(n)
+            before = "-"
+            if n in regex_lengths:
+                assert matches(value) == (fullmatch(regex, value) is not None)
+                # one run is enough to see the exponential cases
+                number = 1 if n > 20 and name.startswith("username") else NUMBER
+                before = f"{best_us(lambda: fullmatch(regex, value), number):.1f}"
+            after = best_us(lambda: matches(value), NUMBER)
+            print(f"{name:<22}{len(value):>8}{before:>14}{after:>14.1f}")
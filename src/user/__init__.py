@@ -0,0 +1,5 @@
+from dotenv import load_dotenv
+
+# modules read their settings from the environment at import time, so .env has
+# to be loaded before any of them are imported
+load_dotenv()
@@ -0,0 +1,42 @@
+from hashlib import blake2b
+from math import ceil, log
+
+
+class BloomFilter:
+    # answers "definitely not added" or "probably added", with false positives at
+    # about error_rate until more than capacity keys have been added
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(64, ceil(-capacity * log(error_rate) / log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        # keys added that weren't already in the filter, an estimate since false
+        # positives aren't counted
+        self.count = 0
+
+    def positions(self, key: str) -> list[int]:
+        # double hashing, k positions out of one 128 bit digest
+        digest = blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> bool:
+        added = False
+        bits = self.bits
+        for position in self.positions(key):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        for position in self.positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
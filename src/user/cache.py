@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Generic, Hashable, TypeVar
+
+from src.user.metrics import register_collector
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+# name -> cache, for the ones exported on /metrics
+caches: dict[str, "LRUCache"] = {}
+
+
+class LRUCache(Generic[K, V]):
+    def __init__(self, maxsize: int, ttl: float, name: str | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        # bumped on every invalidation. loads take it before they start, and
+        # their result is dropped only if their own key was invalidated since
+        self.generation = 0
+        # key -> generation it was last invalidated at, oldest first. past
+        # maxsize the oldest are forgotten, and loads from before the newest
+        # forgotten one are dropped whatever their key
+        self.invalidated: OrderedDict[K, int] = OrderedDict()
+        self.forgotten = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        if name is not None:
+            caches[name] = self
+
+    def get(self, key: K) -> V | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, generation: int | None = None) -> bool:
+        if generation is not None and (
+            self.forgotten > generation or self.invalidated.get(key, 0) > generation
+        ):
+            return False
+        self.entries[key] = (monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def invalidate(self, key: K) -> V | None:
+        self.generation += 1
+        self.invalidated.pop(key, None)
+        self.invalidated[key] = self.generation
+        while len(self.invalidated) > self.maxsize:
+            _, self.forgotten = self.invalidated.popitem(last=False)
+        entry = self.entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        self.generation += 1
+        self.forgotten = self.generation
+        self.invalidated.clear()
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def collect_cache_metrics():
+    stats = {name: cache.stats() for name, cache in caches.items()}
+
+    def samples(key: str) -> list:
+        return [
+            ({"cache": name}, cache_stat[key]) for name, cache_stat in stats.items()
+        ]
+
+    return [
+        ("cache_size", "Entries in the cache", "gauge", samples("size")),
+        ("cache_max_size", "Cache capacity", "gauge", samples("maxsize")),
+        ("cache_hits_total", "Cache hits", "counter", samples("hits")),
+        ("cache_misses_total", "Cache misses", "counter", samples("misses")),
+        (
+            "cache_evictions_total",
+            "Entries evicted to stay under capacity",
+            "counter",
+            samples("evictions"),
+        ),
+        (
+            "cache_expirations_total",
+            "Entries found past their ttl",
+            "counter",
+            samples("expirations"),
+        ),
+    ]
+
+
+register_collector(collect_cache_metrics)
@@ -1,8 +1,24 @@
+import asyncio
+import re
+from asyncio import CancelledError
+from asyncio import TimeoutError as AsyncTimeoutError
+from asyncio import wait_for
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from contextvars import ContextVar
 from enum import Enum, unique
+from functools import lru_cache
+from itertools import count
 from os import getenv
+from time import monotonic
+from typing import AsyncIterator, Callable
 
 import aiomysql
-from attr import fields_dict
+from attr import Factory, define, fields_dict
+from pymysql.err import DataError, IntegrityError, OperationalError, ProgrammingError
+
+from src.user.metrics import ROW_BUCKETS, Histogram, histogram, register_collector
+from src.user.timing import add_span
 
 
 @unique
@@ -12,83 +28,585 @@ class DbName(str, Enum):
     # POST = "user"  # in a production environment these would be separate databases
 
 
-db_pools: dict[DbName, aiomysql.Pool] = {}
-
-
-def attrs_to_db_fields(cls) -> str:
-    return ", ".join(fields_dict(cls).keys())
-
-
-async def get_db(db_name: DbName) -> tuple[aiomysql.Connection, aiomysql.Pool] | None:
-    if db := db_pools.get(db_name):
-        return await db.acquire(), db
-    raise Exception(f"Invalid database {db_name}")
+@define
+class PoolTimeout(Exception):
+    error: str
+
+
+def db_env(db_name: DbName, key: str, default):
+    # DB_<NAME>_<KEY> overrides DB_<KEY>, e.g. DB_FEED_POOL_MAX=20
+    return getenv(f"DB_{db_name.name}_{key}", getenv(f"DB_{key}", default))
+
+
+@define
+class PoolConfig:
+    minsize: int
+    maxsize: int
+    acquire_timeout: float
+    recycle: int
+
+    @classmethod
+    def from_env(cls, db_name: DbName, workers: int = 1) -> "PoolConfig":
+        minsize = int(db_env(db_name, "POOL_MIN", 1))
+        maxsize = int(db_env(db_name, "POOL_MAX", 10))
+        # DB_CONNECTION_BUDGET caps the connections all worker processes open to
+        # one host, each worker gets an equal share of it
+        if budget := db_env(db_name, "CONNECTION_BUDGET", None):
+            maxsize = max(1, int(budget) // workers)
+            minsize = min(minsize, maxsize)
+        return cls(
+            minsize=minsize,
+            maxsize=maxsize,
+            acquire_timeout=float(db_env(db_name, "POOL_ACQUIRE_TIMEOUT", 5)),
+            recycle=int(db_env(db_name, "POOL_RECYCLE", 3600)),
+        )
+
+
+@define
+class PoolStats:
+    waiters: int = 0
+    acquired: int = 0
+    timeouts: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+
+@define
+class Replica:
+    host: str
+    pool: aiomysql.Pool
+    stats: PoolStats = Factory(PoolStats)
+    healthy: bool = True
+    lag: float | None = None
+    # last error from checking replication on a reachable replica, logged once
+    check_error: str | None = None
 
 
-async def select_one(db_name: DbName, query: str, values: tuple):
-    cxn, pool = await get_db(db_name)
-    if not cxn or not pool:
-        raise Exception("Error getting database")
-
-    curr = await cxn.cursor()
-    await curr.execute(query, values)
-    res = await curr.fetchone()
-
-    pool.release(cxn)
+db_pools: dict[DbName, aiomysql.Pool] = {}
+pool_configs: dict[DbName, PoolConfig] = {}
+pool_stats: dict[DbName, PoolStats] = {}
+replica_pools: dict[DbName, list[Replica]] = {}
+
+STREAM_FETCH_SIZE = int(getenv("DB_STREAM_FETCH_SIZE", 500))
+
+REPLICA_MAX_LAG = float(getenv("DB_REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(getenv("DB_REPLICA_CHECK_INTERVAL", 2))
+# seconds a user's reads stick to the primary after they write, 0 disables it
+READ_YOUR_WRITES_WINDOW = float(getenv("DB_READ_YOUR_WRITES_WINDOW", 0))
+
+# set per request by the api_response wrapper so writes can be attributed to a user
+request_user_id: ContextVar[int | None] = ContextVar("request_user_id", default=None)
+recent_writers: OrderedDict[int, float] = OrderedDict()
+
+replica_counter = count()
+replica_monitor: asyncio.Task | None = None
+
+query_seconds = histogram(
+    "db_query_seconds", "Time spent executing a query", ("db", "query")
+)
+query_rows = histogram(
+    "db_query_rows",
+    "Rows returned or affected by a query",
+    ("db", "query"),
+    ROW_BUCKETS,
+)
+pool_acquire_seconds = histogram(
+    "db_pool_acquire_seconds", "Time spent waiting for a connection", ("pool",)
+)
+
+QUERY_TABLE_RE = re.compile(r"\b(?:from|into)\s+`?(\w+)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def query_metrics(db_name: DbName, query: str) -> tuple[Histogram, Histogram]:
+    # queries are labelled "<verb> <table>", e.g. "select post". the lookup is
+    # memoized by query text so the hot path doesn't parse SQL
+    verb, _, rest = query.strip().partition(" ")
+    verb = verb.lower()
+    if verb == "update":
+        table = rest.strip().split(" ", 1)[0]
+    else:
+        match = QUERY_TABLE_RE.search(rest)
+        table = match.group(1) if match else ""
+    name = f"{verb} {table.strip('`')}".strip()
+    return (
+        query_seconds.labels(db_name.value, name),
+        query_rows.labels(db_name.value, name),
+    )
 
-    return res
 
+def observe_query(db_name: DbName, query: str, started: float, rows: int):
+    elapsed = monotonic() - started
+    seconds, row_count = query_metrics(db_name, query)
+    seconds.observe(elapsed)
+    row_count.observe(rows)
+    add_span("db", elapsed)
 
-async def select_all(db_name: DbName, query: str, values: tuple):
-    cxn, pool = await get_db(db_name)
 
-    curr = await cxn.cursor()
-    await curr.execute(query, values)
-    res = await curr.fetchall()
+def attrs_to_db_fields(cls) -> str:
+    return ", ".join(fields_dict(cls).keys())
 
-    pool.release(cxn)
 
-    return res
+@asynccontextmanager
+async def acquire_from(
+    pool: aiomysql.Pool, stats: PoolStats, config: PoolConfig, name: str
+) -> AsyncIterator[aiomysql.Connection]:
+    stats.waiters += 1
+    start = monotonic()
+    try:
+        cxn = await wait_for(pool.acquire(), config.acquire_timeout)
+    except AsyncTimeoutError:
+        stats.timeouts += 1
+        raise PoolTimeout(f"Timed out acquiring a connection to {name}")
+    finally:
+        stats.waiters -= 1
+
+    waited = monotonic() - start
+    pool_acquire_seconds.labels(name).observe(waited)
+    add_span("db_acquire", waited)
+    stats.acquired += 1
+    stats.wait_total += waited
+    stats.wait_max = max(stats.wait_max, waited)
+
+    try:
+        yield cxn
+    except (IntegrityError, ProgrammingError, DataError):
+        # query was rejected by the server, the connection itself is still usable
+        raise
+    except (Exception, CancelledError):
+        # the connection may be mid-query or dead, don't hand it to anyone else
+        cxn.close()
+        raise
+    finally:
+        pool.release(cxn)
+
+
+def acquire(db_name: DbName):
+    pool = db_pools.get(db_name)
+    if not pool:
+        raise Exception(f"Invalid database {db_name}")
+    return acquire_from(pool, pool_stats[db_name], pool_configs[db_name], db_name.value)
+
+
+def note_write():
+    if not READ_YOUR_WRITES_WINDOW or (user_id := request_user_id.get()) is None:
+        return
+    now = monotonic()
+    recent_writers[user_id] = now + READ_YOUR_WRITES_WINDOW
+    recent_writers.move_to_end(user_id)
+    # entries are kept in expiry order, so expired ones are always at the front
+    while recent_writers and next(iter(recent_writers.values())) < now:
+        recent_writers.popitem(last=False)
+
+
+def should_read_primary() -> bool:
+    if not READ_YOUR_WRITES_WINDOW or (user_id := request_user_id.get()) is None:
+        return False
+    expires = recent_writers.get(user_id)
+    return expires is not None and expires > monotonic()
+
+
+def is_connection_error(e: Exception) -> bool:
+    # client side errors (2xxx) mean the server couldn't be reached or went away,
+    # server errors like a missing privilege or a lock wait timeout don't
+    if isinstance(e, PoolTimeout):
+        return True
+    return isinstance(e, OperationalError) and bool(e.args) and 2000 <= e.args[0] < 3000
+
+
+def pick_replica(db_name: DbName) -> Replica | None:
+    healthy = [replica for replica in replica_pools.get(db_name, ()) if replica.healthy]
+    if not healthy:
+        return None
+    return healthy[next(replica_counter) % len(healthy)]
+
+
+async def read(
+    db_name: DbName, query: str, values: tuple, fetch_one: bool, primary: bool
+):
+    if not primary and not should_read_primary():
+        if replica := pick_replica(db_name):
+            try:
+                async with acquire_from(
+                    replica.pool,
+                    replica.stats,
+                    pool_configs[db_name],
+                    f"{db_name.value}@{replica.host}",
+                ) as cxn:
+                    async with cxn.cursor() as curr:
+                        started = monotonic()
+                        await curr.execute(query, values)
+                        result = await (
+                            curr.fetchone() if fetch_one else curr.fetchall()
+                        )
+                        observe_query(db_name, query, started, curr.rowcount)
+                        return result
+            except (OperationalError, PoolTimeout) as e:
+                if is_connection_error(e):
+                    # take it out of rotation until the monitor sees it recover
+                    replica.healthy = False
+
+    async with acquire(db_name) as cxn:
+        async with cxn.cursor() as curr:
+            started = monotonic()
+            await curr.execute(query, values)
+            result = await (curr.fetchone() if fetch_one else curr.fetchall())
+            observe_query(db_name, query, started, curr.rowcount)
+            return result
+
+
+async def stream(
+    db_name: DbName,
+    query: str,
+    values: tuple,
+    fetch_size: int = STREAM_FETCH_SIZE,
+    primary=False,
+) -> AsyncIterator[tuple]:
+    # rows are read from an unbuffered server-side cursor fetch_size at a time, so
+    # memory stays flat regardless of the result size. the connection is held
+    # until the generator is exhausted or closed, use contextlib.aclosing
+    replica = None
+    if not primary and not should_read_primary():
+        replica = pick_replica(db_name)
+    if replica:
+        acquire_cxn = acquire_from(
+            replica.pool,
+            replica.stats,
+            pool_configs[db_name],
+            f"{db_name.value}@{replica.host}",
+        )
+    else:
+        acquire_cxn = acquire(db_name)
+
+    async with acquire_cxn as cxn:
+        async with cxn.cursor(aiomysql.SSCursor) as curr:
+            await curr.execute(query, values)
+            while rows := await curr.fetchmany(fetch_size):
+                for row in rows:
+                    yield row
+
+
+def get_pool_stats() -> dict[str, dict]:
+    def describe(pool: aiomysql.Pool, pool_stat: PoolStats) -> dict:
+        return {
+            "minsize": pool.minsize,
+            "maxsize": pool.maxsize,
+            "size": pool.size,
+            "in_use": pool.size - pool.freesize,
+            "idle": pool.freesize,
+            "waiters": pool_stat.waiters,
+            "acquired": pool_stat.acquired,
+            "timeouts": pool_stat.timeouts,
+            "wait_avg": pool_stat.wait_total / pool_stat.acquired
+            if pool_stat.acquired
+            else 0.0,
+            "wait_max": pool_stat.wait_max,
+        }
+
+    stats = {}
+    for db_name, pool in db_pools.items():
+        stats[db_name.value] = describe(pool, pool_stats[db_name])
+        for replica in replica_pools.get(db_name, ()):
+            stats[f"{db_name.value}@{replica.host}"] = {
+                **describe(replica.pool, replica.stats),
+                "healthy": replica.healthy,
+                "lag": replica.lag,
+            }
+    return stats
+
+
+def collect_pool_metrics():
+    stats = get_pool_stats()
+
+    def samples(key: str) -> list:
+        return [({"pool": pool}, pool_stat[key]) for pool, pool_stat in stats.items()]
+
+    return [
+        ("db_pool_size", "Open connections", "gauge", samples("size")),
+        ("db_pool_in_use", "Connections checked out", "gauge", samples("in_use")),
+        (
+            "db_pool_waiters",
+            "Tasks waiting for a connection",
+            "gauge",
+            samples("waiters"),
+        ),
+        (
+            "db_pool_timeouts_total",
+            "Connection acquires that timed out",
+            "counter",
+            samples("timeouts"),
+        ),
+    ]
+
+
+register_collector(collect_pool_metrics)
+
+
+async def select_one(db_name: DbName, query: str, values: tuple, primary=False):
+    return await read(db_name, query, values, True, primary)
+
+
+async def select_all(db_name: DbName, query: str, values: tuple, primary=False):
+    return await read(db_name, query, values, False, primary)
 
 
 async def insert_one(
     db_name: DbName, query: str, values: tuple, return_last_id=False
 ) -> bool | int:
-    cxn, pool = await get_db(db_name)
-
-    curr = await cxn.cursor()
-    await curr.execute(query, values)
-
-    pool.release(cxn)
-    return curr.lastrowid if return_last_id else True
-
-
-async def delete_one(db_name: DbName, query: str, values: tuple):
-    cxn, pool = await get_db(db_name)
-
-    curr = await cxn.cursor()
-    await curr.execute(query, values)
-
-    pool.release(cxn)
-    return True
+    note_write()
+    async with acquire(db_name) as cxn:
+        async with cxn.cursor() as curr:
+            started = monotonic()
+            await curr.execute(query, values)
+            observe_query(db_name, query, started, curr.rowcount)
+            return curr.lastrowid if return_last_id else True
+
+
+async def delete_one(db_name: DbName, query: str, values: tuple) -> int:
+    note_write()
+    async with acquire(db_name) as cxn:
+        async with cxn.cursor() as curr:
+            started = monotonic()
+            await curr.execute(query, values)
+            observe_query(db_name, query, started, curr.rowcount)
+            # number of rows deleted, so callers can tell a no-op apart
+            return curr.rowcount
 
 
 async def update(db_name: DbName, query: str, values: tuple):
-    cxn, pool = await get_db(db_name)
-
-    curr = await cxn.cursor()
-    await curr.execute(query, values)
-
-    pool.release(cxn)
+    note_write()
+    async with acquire(db_name) as cxn:
+        async with cxn.cursor() as curr:
+            started = monotonic()
+            await curr.execute(query, values)
+            observe_query(db_name, query, started, curr.rowcount)
     return True
 
 
-async def create_pool(db_name: DbName):
-    db_pools[db_name] = await aiomysql.create_pool(
-        host=getenv("DB_HOST"),
+@define
+class Transaction:
+    db_name: DbName
+    cxn: aiomysql.Connection
+    committed_callbacks: list[tuple[Callable, tuple]] = Factory(list)
+
+    def after_commit(self, fn: Callable, *args):
+        # for side effects that must only happen if the transaction commits
+        self.committed_callbacks.append((fn, args))
+
+    async def execute(self, query: str, values: tuple) -> aiomysql.Cursor:
+        curr = await self.cxn.cursor()
+        started = monotonic()
+        await curr.execute(query, values)
+        observe_query(self.db_name, query, started, curr.rowcount)
+        return curr
+
+    async def select_one(self, query: str, values: tuple):
+        async with await self.execute(query, values) as curr:
+            return await curr.fetchone()
+
+    async def select_all(self, query: str, values: tuple):
+        async with await self.execute(query, values) as curr:
+            return await curr.fetchall()
+
+    async def insert_one(
+        self, query: str, values: tuple, return_last_id=False
+    ) -> bool | int:
+        async with await self.execute(query, values) as curr:
+            return curr.lastrowid if return_last_id else True
+
+    async def update(self, query: str, values: tuple):
+        async with await self.execute(query, values):
+            return True
+
+    async def delete_one(self, query: str, values: tuple) -> int:
+        async with await self.execute(query, values) as curr:
+            return curr.rowcount
+
+
+@asynccontextmanager
+async def transaction(db_name: DbName) -> AsyncIterator[Transaction]:
+    # statements run on one primary connection and are committed together when
+    # the block exits, or rolled back if it raises
+    note_write()
+    async with acquire(db_name) as cxn:
+        await cxn.begin()
+        tx = Transaction(db_name, cxn)
+        try:
+            yield tx
+        except BaseException:
+            try:
+                await cxn.rollback()
+            except Exception:
+                # the original error matters more, and the server rolls back an
+                # open transaction when its connection goes away
+                cxn.close()
+            raise
+        started = monotonic()
+        await cxn.commit()
+        observe_query(db_name, "commit", started, 0)
+    for fn, args in tx.committed_callbacks:
+        fn(*args)
+
+
+async def check_replica(db_name: DbName, replica: Replica):
+    try:
+        async with acquire_from(
+            replica.pool,
+            replica.stats,
+            pool_configs[db_name],
+            f"{db_name.value}@{replica.host}",
+        ) as cxn:
+            async with cxn.cursor(aiomysql.DictCursor) as curr:
+                try:
+                    await curr.execute("show replica status")
+                except ProgrammingError:
+                    # MySQL < 8.0.22
+                    await curr.execute("show slave status")
+                status = await curr.fetchone()
+    except (OperationalError, PoolTimeout) as e:
+        replica.lag = None
+        if is_connection_error(e):
+            replica.healthy = False
+            return
+        # the replica answered, but its lag can't be read, e.g. the user lacks
+        # REPLICATION CLIENT. it stays in rotation with an unknown lag
+        if str(e) != replica.check_error:
+            print(f"Can't check replication on {db_name.value}@{replica.host}: {e}")
+        replica.check_error = str(e)
+        replica.healthy = True
+        return
+
+    replica.check_error = None
+
+    if not status:
+        # not configured as a replica, so it can't fall behind
+        replica.lag = 0.0
+    else:
+        lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+        # a null lag means replication is stopped
+        replica.lag = float(lag) if lag is not None else None
+    replica.healthy = replica.lag is not None and replica.lag <= REPLICA_MAX_LAG
+
+
+async def monitor_replicas():
+    while True:
+        await asyncio.gather(
+            *(
+                check_replica(db_name, replica)
+                for db_name, replicas in replica_pools.items()
+                for replica in replicas
+            )
+        )
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+
+def start_replica_monitor():
+    global replica_monitor
+    if any(replica_pools.values()) and replica_monitor is None:
+        replica_monitor = asyncio.create_task(monitor_replicas())
+
+
+async def open_pool(db_name: DbName, host: str, config: PoolConfig) -> aiomysql.Pool:
+    return await aiomysql.create_pool(
+        host=host,
         user=getenv("DB_USER"),
         password=getenv("DB_PASSWORD"),
         db=db_name.value,
         port=3306,
         autocommit=True,
+        minsize=config.minsize,
+        maxsize=config.maxsize,
+        pool_recycle=config.recycle,
+    )
+
+
+async def create_pool(db_name: DbName, workers: int = 1):
+    config = PoolConfig.from_env(db_name, workers)
+    db_pools[db_name] = await open_pool(db_name, getenv("DB_HOST"), config)
+    pool_configs[db_name] = config
+    pool_stats[db_name] = PoolStats()
+
+    # DB_<NAME>_REPLICA_HOSTS / DB_REPLICA_HOSTS, comma separated
+    replica_hosts = [
+        host.strip()
+        for host in db_env(db_name, "REPLICA_HOSTS", "").split(",")
+        if host.strip()
+    ]
+    replica_pools[db_name] = [
+        Replica(host, await open_pool(db_name, host, config)) for host in replica_hosts
+    ]
+
+
+async def warm_pool_from(
+    pool: aiomysql.Pool,
+    stats: PoolStats,
+    config: PoolConfig,
+    name: str,
+    queries: tuple[str, ...],
+):
+    # hold minsize connections at once so each one is opened and checked instead
+    # of the same idle connection being handed back every time
+    async with AsyncExitStack() as stack:
+        cxns = [
+            await stack.enter_async_context(acquire_from(pool, stats, config, name))
+            for _ in range(config.minsize)
+        ]
+        for i, cxn in enumerate(cxns):
+            async with cxn.cursor() as curr:
+                await curr.execute("select 1")
+                # the warmup set only needs to run once per server
+                if i == 0:
+                    for query in queries:
+                        await curr.execute(query)
+                        await curr.fetchall()
+
+
+async def warm_pool(db_name: DbName, queries: tuple[str, ...] = ()):
+    config = pool_configs[db_name]
+    await warm_pool_from(
+        db_pools[db_name], pool_stats[db_name], config, db_name.value, queries
     )
+    for replica in replica_pools.get(db_name, ()):
+        try:
+            await warm_pool_from(
+                replica.pool,
+                replica.stats,
+                config,
+                f"{db_name.value}@{replica.host}",
+                queries,
+            )
+        except (OperationalError, PoolTimeout):
+            # a broken replica shouldn't stop startup, reads go to the primary
+            replica.healthy = False
+
+
+async def ping(db_name: DbName) -> bool:
+    try:
+        async with acquire(db_name) as cxn:
+            async with cxn.cursor() as curr:
+                await curr.execute("select 1")
+    except (OperationalError, PoolTimeout):
+        return False
+    return True
+
+
+async def close_pools():
+    global replica_monitor
+    if replica_monitor is not None:
+        replica_monitor.cancel()
+        try:
+            await replica_monitor
+        except CancelledError:
+            pass
+        replica_monitor = None
+
+    pools = list(db_pools.values()) + [
+        replica.pool for replicas in replica_pools.values() for replica in replicas
+    ]
+    for pool in pools:
+        pool.close()
+    await asyncio.gather(*(pool.wait_closed() for pool in pools))
+    db_pools.clear()
+    pool_configs.clear()
+    pool_stats.clear()
+    replica_pools.clear()
@@ -1,20 +1,36 @@
 import asyncio
+import traceback
+from contextlib import aclosing
 from enum import Enum, unique
-from typing import Optional
+from os import getenv
+from time import monotonic
+from typing import AsyncIterator, Optional
 
 from attr import define
 from pymysql.err import IntegrityError
 
 from src.user.db import (
     DbName,
+    Transaction,
     attrs_to_db_fields,
     delete_one,
     insert_one,
     select_all,
     select_one,
+    should_read_primary,
+    stream,
+    transaction,
+)
+from src.user.loader import BatchLoader
+from src.user.tasks import COUNTER_MODE
+from src.user.tasks.supervisor import register_task, submit, submit_wait
+from src.user.tasks.update_follower_count import apply_follow_delta
+from src.user.tasks.update_post_counts import (
+    apply_post_comment_delta,
+    apply_post_like_delta,
+    mark_post_comment_count_dirty,
+    mark_post_like_count_dirty,
 )
-from src.user.tasks.update_follower_count import update_follower_count
-from src.user.tasks.update_post_counts import update_post_comment_count, update_post_like_count
 
 
 @define
@@ -67,7 +83,16 @@ COMMENT_DB_KEYS = attrs_to_db_fields(PostComment)
 
 
 POST_FETCH_LIMIT = 10
+POST_FETCH_MAX = 50
 COMMENT_FETCH_LIMIT = 5
+COMMENT_FETCH_MAX = 50
+
+# accounts with at least this many followers aren't fanned out on write, their
+# posts are merged into followers' timelines at read time instead
+FANOUT_MAX_FOLLOWERS = int(getenv("FANOUT_MAX_FOLLOWERS", 10000))
+# seconds the set of those accounts is reused before it's loaded again
+LARGE_ACCOUNTS_REFRESH = float(getenv("LARGE_ACCOUNTS_REFRESH", 30))
+TIMELINE_BACKFILL_POSTS = int(getenv("TIMELINE_BACKFILL_POSTS", 20))
 
 
 async def get_post_by_id(post_id: int) -> Post:
@@ -82,58 +107,146 @@ async def get_post_by_id(post_id: int) -> Post:
     return Post(*post)
 
 
-async def get_posts_by_user_id(user_id: int) -> list[Post]:
+# pages are keyset cursors on (date, id), newest first. these are served by the
+# indexes on `post` (`user_id`, `date`, `post_id`) and `post_comment` (`post_id`,
+# `date`, `comment_id`) so a deep page costs the same as the first one
+async def get_posts_by_user_id(
+    user_id: int,
+    cursor: Optional[tuple[int, int]] = None,
+    limit: int = POST_FETCH_LIMIT,
+) -> list[Post]:
+    query = (
+        "select `post_id`, `user_id`, `date`, `text`, `num_comments`, `num_likes`, `num_shares` from `post` "
+        "where `user_id` = %s"
+    )
+    values = [user_id]
+    if cursor:
+        query += " and (`date` < %s or (`date` = %s and `post_id` < %s))"
+        values.extend((cursor[0], cursor[0], cursor[1]))
+    query += " order by `date` desc, `post_id` desc limit %s"
+    values.append(limit)
+
+    posts = await select_all(DbName.FEED, query, tuple(values))
+    if not posts and not cursor:
+        raise PostNotFound(f"No posts found")
+    return [Post(*post) for post in posts]
+
+
+async def get_posts_by_ids(post_ids: list[int]) -> dict[int, Post]:
+    post_ids_string = ",".join(["%s"] * len(post_ids))
     posts = await select_all(
         DbName.FEED,
         "select `post_id`, `user_id`, `date`, `text`, `num_comments`, `num_likes`, `num_shares` from `post` where "
-        "`user_id` = %s order by `date` desc limit %s",
-        (user_id, POST_FETCH_LIMIT),
+        f"`post_id` in ({post_ids_string})",
+        tuple(post_ids),
     )
-    if not posts:
-        raise PostNotFound(f"No posts found")
-    return [Post(*post) for post in posts]
+    return {post[0]: Post(*post) for post in posts}
 
 
-async def like_post(user_id: int, post_id: int) -> bool:
-    try:
-        await insert_one(
+async def stream_posts_by_user_id(user_id: int) -> AsyncIterator[Post]:
+    async with aclosing(
+        stream(
             DbName.FEED,
-            "insert into `post_like` (`user_id`, `post_id`) values (%s, %s)",
-            (user_id, post_id),
+            "select `post_id`, `user_id`, `date`, `text`, `num_comments`, `num_likes`, `num_shares` from `post` where "
+            "`user_id` = %s order by `post_id`",
+            (user_id,),
         )
+    ) as rows:
+        async for post in rows:
+            yield Post(*post)
+
+
+# called inside the transaction that changed the row, a delta commits or rolls
+# back together with it and a recount is only scheduled once it has committed
+async def post_like_count_changed(tx: Transaction, post_id: int, delta: int):
+    if COUNTER_MODE == "delta":
+        await apply_post_like_delta(tx, post_id, delta)
+    else:
+        tx.after_commit(mark_post_like_count_dirty, post_id)
+
+
+async def post_comment_count_changed(tx: Transaction, post_id: int, delta: int):
+    if COUNTER_MODE == "delta":
+        await apply_post_comment_delta(tx, post_id, delta)
+    else:
+        tx.after_commit(mark_post_comment_count_dirty, post_id)
+
+
+def submit_follow_recount(follower_id: int, following_id: int):
+    submit("follower_count", following_id, key=following_id)
+    submit("following_count", follower_id, key=follower_id)
+
+
+async def follow_count_changed(follower_id: int, following_id: int, delta: int):
+    if COUNTER_MODE != "delta":
+        submit_follow_recount(follower_id, following_id)
+        return
+    # the counters are in the user database, so they can't share a transaction
+    # with the follow. recounted if applying them failed
+    try:
+        await apply_follow_delta(follower_id, following_id, delta)
+    except Exception:
+        traceback.print_exc()
+        submit_follow_recount(follower_id, following_id)
+
+
+async def follow_changed(follower_id: int, following_id: int, delta: int):
+    # counters first, the timeline job may have to wait for room in the queue
+    await follow_count_changed(follower_id, following_id, delta)
+    await submit_wait(
+        "timeline_follow",
+        follower_id,
+        following_id,
+        key=(follower_id, following_id),
+    )
+
+
+async def like_post(user_id: int, post_id: int) -> bool:
+    try:
+        async with transaction(DbName.FEED) as tx:
+            await tx.insert_one(
+                "insert into `post_like` (`user_id`, `post_id`) values (%s, %s)",
+                (user_id, post_id),
+            )
+            await post_like_count_changed(tx, post_id, 1)
     except IntegrityError:
         return False
-
-    asyncio.create_task(update_post_like_count(post_id))
     return True
 
 
 async def unlike_post(user_id: int, post_id: int):
-    await delete_one(
+    async with transaction(DbName.FEED) as tx:
+        deleted = await tx.delete_one(
+            "delete from `post_like` where `user_id` = %s and `post_id` = %s",
+            (user_id, post_id),
+        )
+        if deleted:
+            await post_like_count_changed(tx, post_id, -1)
+
+
+async def load_post_likes(keys: list[tuple[int, int]]) -> dict[tuple[int, int], bool]:
+    pairs_string = ",".join(["(%s, %s)"] * len(keys))
+    res = await select_all(
         DbName.FEED,
-        "delete from `post_like` where `user_id` = %s and `post_id` = %s",
-        (user_id, post_id),
+        f"select `user_id`, `post_id` from `post_like` where (`user_id`, `post_id`) in ({pairs_string})",
+        tuple(value for key in keys for value in key),
     )
-    asyncio.create_task(update_post_like_count(post_id))
+    return {(int(like[0]), int(like[1])): True for like in res}
+
+
+# keyed by (user_id, post_id)
+post_like_loader: BatchLoader[tuple[int, int], bool] = BatchLoader(
+    load_post_likes, bypass=should_read_primary
+)
 
 
 async def is_post_liked_by_user_id(post_id: int, user_id: int) -> bool:
-    res = await select_one(
-        DbName.FEED,
-        "select 1 from `post_like` where `post_id` = %s and `user_id` = %s",
-        (post_id, user_id),
-    )
-    return res is not None
+    return await post_like_loader.load((user_id, post_id)) is not None
 
 
 async def are_posts_liked_by_user_id(post_ids: list[int], user_id: int) -> tuple[int]:
-    post_ids_string = ",".join(["%s"] * len(post_ids))
-    res = await select_all(
-        DbName.FEED,
-        f"select `post_id` from `post_like` where `post_id` in ({post_ids_string}) and `user_id` = %s",
-        (*post_ids, user_id),
-    )
-    return tuple(int(post[0]) for post in res if res)
+    liked = await post_like_loader.load_many((user_id, post_id) for post_id in post_ids)
+    return tuple(post_id for _, post_id in liked)
 
 
 async def is_user_id_following_user_id(follower_id: int, following_id: int) -> bool:
@@ -145,6 +258,19 @@ async def is_user_id_following_user_id(follower_id: int, following_id: int) -> b
     return is_following is not None
 
 
+async def are_users_followed_by_user_id(
+    following_ids: list[int], follower_id: int
+) -> tuple[int]:
+    following_ids_string = ",".join(["%s"] * len(following_ids))
+    res = await select_all(
+        DbName.FEED,
+        "select `following_id` from `following` where `follower_id` = %s and "
+        f"`following_id` in ({following_ids_string})",
+        (follower_id, *following_ids),
+    )
+    return tuple(int(row[0]) for row in res)
+
+
 async def follow_user(user_id: int, following_id: int) -> bool:
     try:
         await insert_one(
@@ -154,17 +280,20 @@ async def follow_user(user_id: int, following_id: int) -> bool:
         )
     except IntegrityError:
         return False
-    asyncio.create_task(update_follower_count(following_id))
+    # the row is written, shielded so a cancelled request still updates the
+    # counters and queues the timeline job
+    await asyncio.shield(follow_changed(user_id, following_id, 1))
     return True
 
 
 async def unfollow_user(follower_id: int, following_id: int):
-    await delete_one(
+    deleted = await delete_one(
         DbName.FEED,
         "delete from `following` where `follower_id` = %s and `following_id` = %s",
         (follower_id, following_id),
     )
-    asyncio.create_task(update_follower_count(following_id))
+    if deleted:
+        await asyncio.shield(follow_changed(follower_id, following_id, -1))
 
 
 async def create_post(user_id: int, text: str) -> int:
@@ -174,36 +303,46 @@ async def create_post(user_id: int, text: str) -> int:
         (user_id, text),
         return_last_id=True,
     )
+    await submit_wait("timeline_fanout", user_id, post_id)
     return post_id
 
 
 async def get_comments_by_post_id(
-    post_id: int, last_id: Optional[int] = None
+    post_id: int,
+    cursor: Optional[tuple[int, int]] = None,
+    limit: int = COMMENT_FETCH_LIMIT,
 ) -> list[PostComment]:
-    limit = COMMENT_FETCH_LIMIT
     query = f"select {COMMENT_DB_KEYS} from `post_comment` where `post_id` = %s"
     values = [post_id]
-
-    # if no last_id is present, this is the first fetch for a post, so we only display the most recent comment
-    if not last_id:
-        limit = 1
-    else:
-        query += " and `comment_id` < %s"
-        values.append(last_id)
-    query += " order by `date` desc limit %s"
+    if cursor:
+        query += " and (`date` < %s or (`date` = %s and `comment_id` < %s))"
+        values.extend((cursor[0], cursor[0], cursor[1]))
+    query += " order by `date` desc, `comment_id` desc limit %s"
     values.append(limit)
     comments = await select_all(DbName.FEED, query, tuple(values))
     return [PostComment(*comment) for comment in comments]
 
 
+async def stream_comments_by_user_id(user_id: int) -> AsyncIterator[PostComment]:
+    async with aclosing(
+        stream(
+            DbName.FEED,
+            f"select {COMMENT_DB_KEYS} from `post_comment` where `user_id` = %s order by `comment_id`",
+            (user_id,),
+        )
+    ) as rows:
+        async for comment in rows:
+            yield PostComment(*comment)
+
+
 async def create_comment(post_id: int, user_id: int, text: str) -> int:
-    comment_id = await insert_one(
-        DbName.FEED,
-        "insert into `post_comment` (`user_id`, `date`, `text`, `post_id`) values (%s, UNIX_TIMESTAMP(), %s, %s)",
-        (user_id, text, post_id),
-        return_last_id=True,
-    )
-    asyncio.create_task(update_post_comment_count(post_id))
+    async with transaction(DbName.FEED) as tx:
+        comment_id = await tx.insert_one(
+            "insert into `post_comment` (`user_id`, `date`, `text`, `post_id`) values (%s, UNIX_TIMESTAMP(), %s, %s)",
+            (user_id, text, post_id),
+            return_last_id=True,
+        )
+        await post_comment_count_changed(tx, post_id, 1)
     return comment_id
 
 
@@ -215,3 +354,143 @@ async def set_comment_visibility(
         "update `post_comment` set `visibility` = %s where user_id = %s and comment_id = %s",
         (visibility.value, user_id, comment_id),
     )
+
+
+@define
+class LargeAccounts:
+    user_ids: frozenset[int] = frozenset()
+    expires: float = 0.0
+
+
+large_accounts = LargeAccounts()
+large_accounts_lock = asyncio.Lock()
+
+
+async def get_large_accounts() -> frozenset[int]:
+    # the few accounts at or over FANOUT_MAX_FOLLOWERS, served by an index on
+    # `profile` (`follower_count`). writes and reads of timelines both go by this
+    # set so they agree on who is fanned out on read
+    if large_accounts.expires > monotonic():
+        return large_accounts.user_ids
+    async with large_accounts_lock:
+        if large_accounts.expires <= monotonic():
+            rows = await select_all(
+                DbName.USER,
+                "select `user_id` from `profile` where `follower_count` >= %s",
+                (FANOUT_MAX_FOLLOWERS,),
+            )
+            large_accounts.user_ids = frozenset(row[0] for row in rows)
+            large_accounts.expires = monotonic() + LARGE_ACCOUNTS_REFRESH
+    return large_accounts.user_ids
+
+
+async def is_fanned_out_on_read(user_id: int) -> bool:
+    return user_id in await get_large_accounts()
+
+
+async def fan_out_post(user_id: int, post_id: int):
+    # the author always gets their own post, followers only when the author is
+    # small enough to fan out on write
+    query = "insert ignore into `timeline` (`user_id`, `post_id`, `date`) select `user_id`, `post_id`, `date` from `post` where `post_id` = %s"
+    values = [post_id]
+    if not await is_fanned_out_on_read(user_id):
+        query += (
+            " union all select `following`.`follower_id`, `post`.`post_id`, `post`.`date` from `post` "
+            "join `following` on `following`.`following_id` = `post`.`user_id` where `post`.`post_id` = %s"
+        )
+        values.append(post_id)
+    await insert_one(DbName.FEED, query, tuple(values))
+
+
+async def backfill_timeline(follower_id: int, following_id: int):
+    if await is_fanned_out_on_read(following_id):
+        return
+    await insert_one(
+        DbName.FEED,
+        "insert ignore into `timeline` (`user_id`, `post_id`, `date`) select %s, `post_id`, `date` from `post` "
+        "where `user_id` = %s order by `date` desc, `post_id` desc limit %s",
+        (follower_id, following_id, TIMELINE_BACKFILL_POSTS),
+    )
+
+
+async def remove_from_timeline(follower_id: int, following_id: int):
+    await delete_one(
+        DbName.FEED,
+        "delete `timeline` from `timeline` join `post` on `post`.`post_id` = `timeline`.`post_id` "
+        "where `timeline`.`user_id` = %s and `post`.`user_id` = %s",
+        (follower_id, following_id),
+    )
+
+
+async def sync_followed_timeline(follower_id: int, following_id: int):
+    # one job for follows and unfollows, keyed by the pair so they run in order.
+    # it goes by the current state, so after a quick follow, unfollow and follow
+    # the timeline is backfilled even if some of their jobs were deduplicated
+    following = await select_one(
+        DbName.FEED,
+        "select 1 from `following` where `follower_id` = %s and `following_id` = %s",
+        (follower_id, following_id),
+        primary=True,
+    )
+    if following:
+        await backfill_timeline(follower_id, following_id)
+    else:
+        await remove_from_timeline(follower_id, following_id)
+
+
+register_task("timeline_fanout", fan_out_post)
+register_task("timeline_follow", sync_followed_timeline)
+
+
+async def get_timeline(
+    user_id: int,
+    cursor: Optional[tuple[int, int]] = None,
+    limit: int = POST_FETCH_LIMIT,
+) -> list[Post]:
+    # materialized part, served by the (`user_id`, `date`, `post_id`) index on `timeline`
+    query = "select `post_id` from `timeline` where `user_id` = %s"
+    values = [user_id]
+    if cursor:
+        query += " and (`date` < %s or (`date` = %s and `post_id` < %s))"
+        values.extend((cursor[0], cursor[0], cursor[1]))
+    query += " order by `date` desc, `post_id` desc limit %s"
+    values.append(limit)
+    timeline = await select_all(DbName.FEED, query, tuple(values))
+    posts = (
+        list((await get_posts_by_ids([row[0] for row in timeline])).values())
+        if timeline
+        else []
+    )
+
+    # fan-out-on-read part, recent posts from followed high-follower accounts.
+    # only the large accounts are looked up in `following`, by its primary key,
+    # rather than everyone the user follows
+    large_followed = []
+    if large_ids := await get_large_accounts():
+        rows = await select_all(
+            DbName.FEED,
+            "select `following_id` from `following` where `follower_id` = %s and "
+            f"`following_id` in ({','.join(['%s'] * len(large_ids))})",
+            (user_id, *large_ids),
+        )
+        large_followed = [row[0] for row in rows]
+    if large_followed:
+        query = (
+            "select `post_id`, `user_id`, `date`, `text`, `num_comments`, `num_likes`, `num_shares` from `post` "
+            f"where `user_id` in ({','.join(['%s'] * len(large_followed))})"
+        )
+        values = list(large_followed)
+        if cursor:
+            query += " and (`date` < %s or (`date` = %s and `post_id` < %s))"
+            values.extend((cursor[0], cursor[0], cursor[1]))
+        query += " order by `date` desc, `post_id` desc limit %s"
+        values.append(limit)
+        posts.extend(
+            Post(*post) for post in await select_all(DbName.FEED, query, tuple(values))
+        )
+
+    # an account that crossed the threshold can have posts in both parts
+    merged = {post.post_id: post for post in posts}
+    return sorted(
+        merged.values(), key=lambda post: (post.date, post.post_id), reverse=True
+    )[:limit]
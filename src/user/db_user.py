@@ -1,16 +1,30 @@
-from asyncio import get_running_loop
-
-from attr import define
+import asyncio
+import re
+import traceback
+import unicodedata
+from contextlib import aclosing
+from os import getenv
+
+from attr import define, fields_dict
 from bcrypt import checkpw, gensalt, hashpw
+from pymysql.constants import ER
+from pymysql.err import IntegrityError
 
+from src.user.bloom import BloomFilter
+from src.user.cache import LRUCache
 from src.user.db import (
     DbName,
     attrs_to_db_fields,
-    insert_one,
     select_all,
     select_one,
+    should_read_primary,
+    stream,
+    transaction,
     update,
 )
+from src.user.hashing import run_password_hash
+from src.user.loader import BatchLoader
+from src.user.metrics import counter, register_collector
 
 
 @define
@@ -18,6 +32,16 @@ class AccountNotFound(Exception):
     error: str
 
 
+@define
+class UsernameTaken(Exception):
+    error: str
+
+
+@define
+class EmailTaken(Exception):
+    error: str
+
+
 @define
 class Account:
     user_id: int
@@ -38,19 +62,60 @@ class Profile:
 
 ACCOUNT_DB_KEYS = attrs_to_db_fields(Account)
 PROFILE_DB_KEYS = attrs_to_db_fields(Profile)
+# for queries that join profile with account, where user_id and username are ambiguous
+PROFILE_JOIN_KEYS = ", ".join(f"`profile`.`{key}`" for key in fields_dict(Profile))
+
+# "Duplicate entry 'x' for key 'account.username'", MySQL < 8 leaves out the table
+DUPLICATE_KEY_RE = re.compile(r"for key '(?:\w+\.)?(\w+)'")
+
+PROFILE_CACHE_SIZE = int(getenv("PROFILE_CACHE_SIZE", 10000))
+PROFILE_CACHE_TTL = float(getenv("PROFILE_CACHE_TTL", 60))
+
+profile_cache: LRUCache[int, Profile] = LRUCache(
+    PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, "profile"
+)
+# account username as requested -> user_id. account usernames never change, so
+# unlike the profile's display name these don't need invalidating
+account_username_cache: LRUCache[str, int] = LRUCache(
+    PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, "account_username"
+)
+
+# filter of account usernames, lookups for names it has definitely never seen
+# don't query the database. None until it's loaded, then every name may exist
+USERNAME_FILTER_CAPACITY = int(getenv("USERNAME_FILTER_CAPACITY", 1_000_000))
+USERNAME_FILTER_ERROR_RATE = float(getenv("USERNAME_FILTER_ERROR_RATE", 0.01))
+# seconds between scans for accounts created by other processes, 0 disables the filter
+USERNAME_FILTER_REFRESH = float(getenv("USERNAME_FILTER_REFRESH", 5))
+# ids under the highest one loaded that each refresh scans again, so an account
+# whose insert committed after a higher id was loaded isn't missed
+USERNAME_FILTER_REFRESH_OVERLAP = int(getenv("USERNAME_FILTER_REFRESH_OVERLAP", 1000))
+
+
+@define
+class UsernameFilter:
+    bloom: BloomFilter
+    max_user_id: int = 0
+
+
+username_filter: UsernameFilter | None = None
+username_filter_refresher: asyncio.Task | None = None
+
+username_filter_lookups = counter(
+    "username_filter_lookups_total", "Username filter checks", ("result",)
+)
+username_filter_misses = username_filter_lookups.labels("miss")
+username_filter_maybes = username_filter_lookups.labels("maybe")
 
 
 async def encrypt_password(password: str) -> str:
     return (
-        await get_running_loop().run_in_executor(
-            None, hashpw, password.encode("utf-8"), gensalt()
-        )
+        await run_password_hash("hash", hashpw, password.encode("utf-8"), gensalt())
     ).decode("utf-8")
 
 
 async def check_password(password: str, hashed_password: str) -> bool:
-    return await get_running_loop().run_in_executor(
-        None, checkpw, password.encode("utf-8"), hashed_password.encode("utf-8")
+    return await run_password_hash(
+        "check", checkpw, password.encode("utf-8"), hashed_password.encode("utf-8")
     )
 
 
@@ -76,40 +141,75 @@ async def get_account_by_username(username: str) -> Account:
     return Account(*user)
 
 
-async def get_user_id_by_username(username: str) -> int:
-    user = await select_one(
-        DbName.USER,
-        "select `user_id` from `account` where username = %s",
-        (username,),
-    )
-    if not user:
-        raise AccountNotFound(f"Username: {username} not found")
-    return user[0]
+def cache_profile(profile: Profile, generation: int):
+    # generation is taken before the load, the result is dropped if the profile
+    # was invalidated since
+    profile_cache.set(profile.user_id, profile, generation)
 
 
-async def get_profile_by_user_id(user_id: int) -> Profile:
-    profile = await select_one(
-        DbName.USER,
-        f"select {PROFILE_DB_KEYS} from profile where user_id = %s",
-        (user_id,),
-    )
-    if not profile:
-        raise AccountNotFound(f"Profile: Id {user_id} not found")
-    return Profile(*profile)
+def invalidate_profile(user_id: int):
+    profile_cache.invalidate(user_id)
 
 
-async def get_profile_by_username(username: str) -> Profile:
+async def get_profile_by_account_username(username: str) -> Profile:
+    # by the account's username, which unlike the profile's display name never changes
+    if (user_id := account_username_cache.get(username)) is not None:
+        if profile := profile_cache.get(user_id):
+            return profile
+    if not username_may_exist(username):
+        raise AccountNotFound(f"Profile: {username} not found")
+
+    generation = profile_cache.generation
     profile = await select_one(
         DbName.USER,
-        f"select {PROFILE_DB_KEYS} from profile where username = %s",
+        f"select {PROFILE_JOIN_KEYS} from `account` join `profile` on "
+        "`profile`.`user_id` = `account`.`user_id` where `account`.`username` = %s",
         (username,),
     )
     if not profile:
         raise AccountNotFound(f"Profile: {username} not found")
-    return Profile(*profile)
+    profile = Profile(*profile)
+    cache_profile(profile, generation)
+    account_username_cache.set(username, profile.user_id)
+    return profile
+
+
+async def get_profiles_by_usernames(usernames: set[str]) -> dict[str, Profile]:
+    # by account username like get_profile_by_account_username, keyed by the
+    # names as requested rather than as stored, which can differ in case
+    profiles = {}
+    missing = []
+    for username in usernames:
+        user_id = account_username_cache.get(username)
+        profile = profile_cache.get(user_id) if user_id is not None else None
+        if profile:
+            profiles[username] = profile
+        elif username_may_exist(username):
+            missing.append(username)
+
+    if missing:
+        generation = profile_cache.generation
+        # field() finds which requested name each row matched, comparing with the
+        # column's collation like the in() does. of several requested names for
+        # the same account, e.g. differing only in case, only the first resolves
+        username_list_str = ",".join(["%s"] * len(missing))
+        rows = await select_all(
+            DbName.USER,
+            f"select field(`account`.`username`, {username_list_str}), {PROFILE_JOIN_KEYS} "
+            "from `account` join `profile` on `profile`.`user_id` = `account`.`user_id` "
+            f"where `account`.`username` in ({username_list_str})",
+            (*missing, *missing),
+        )
+        for index, *row in rows:
+            username = missing[index - 1]
+            profile = Profile(*row)
+            cache_profile(profile, generation)
+            account_username_cache.set(username, profile.user_id)
+            profiles[username] = profile
+    return profiles
 
 
-async def get_profiles_by_user_ids(user_ids: set[int]) -> dict[int, Profile]:
+async def load_profiles(user_ids: list[int]) -> dict[int, Profile]:
     profile_list_str = ",".join(["%s"] * len(user_ids))
     profiles = await select_all(
         DbName.USER,
@@ -119,6 +219,30 @@ async def get_profiles_by_user_ids(user_ids: set[int]) -> dict[int, Profile]:
     return {profile[0]: Profile(*profile) for profile in profiles}
 
 
+# users who just wrote read on their own so the read goes to the primary
+profile_loader: BatchLoader[int, Profile] = BatchLoader(
+    load_profiles, bypass=should_read_primary
+)
+
+
+async def get_profiles_by_user_ids(user_ids: set[int]) -> dict[int, Profile]:
+    profiles = {}
+    missing = []
+    for user_id in user_ids:
+        if profile := profile_cache.get(user_id):
+            profiles[user_id] = profile
+        else:
+            missing.append(user_id)
+
+    if missing:
+        generation = profile_cache.generation
+        loaded = await profile_loader.load_many(missing)
+        for profile in loaded.values():
+            cache_profile(profile, generation)
+        profiles.update(loaded)
+    return profiles
+
+
 async def update_user_profile(
     user_id: int, username: str, bio: str, header_image_url: str
 ):
@@ -132,32 +256,159 @@ async def update_user_profile(
             user_id,
         ),
     )
+    invalidate_profile(user_id)
+
+
+def account_conflict(e: IntegrityError, username: str) -> Exception:
+    # which of the account's unique keys the insert ran into
+    match = DUPLICATE_KEY_RE.search(e.args[1]) if e.args[0] == ER.DUP_ENTRY else None
+    key = match.group(1).lower() if match else ""
+    if "username" in key:
+        return UsernameTaken(f"Username {username} is taken")
+    if "email" in key:
+        return EmailTaken("Email is already in use")
+    return e
+
+
+async def create_account_with_profile(
+    username: str, password: str, email_address: str, bio: str, header_image_url: str
+) -> int:
+    # the account and its profile are created together or not at all, and the
+    # unique key on the username decides races between signups for the same name
+    async with transaction(DbName.USER) as tx:
+        try:
+            user_id = await tx.insert_one(
+                "insert into account (username, password, email_address) values(%s, %s, %s)",
+                (
+                    username,
+                    password,
+                    email_address,
+                ),
+                return_last_id=True,
+            )
+        except IntegrityError as e:
+            raise account_conflict(e, username)
+        # a duplicate here isn't the client's to fix, it stays an error
+        await tx.insert_one(
+            "insert into profile (user_id, username, bio, header_image_url) values(%s, %s, %s, %s)",
+            (
+                user_id,
+                username,
+                bio,
+                header_image_url,
+            ),
+        )
+    if username_filter is not None:
+        username_filter.bloom.add(username_filter_key(username))
+    return user_id
 
 
-async def create_user_account(username: str, password: str, email_address: str) -> int:
-    user_id = await insert_one(
-        DbName.USER,
-        "insert into account (username, password, email_address) values(%s, %s, %s)",
-        (
-            username,
-            password,
-            email_address,
-        ),
-        return_last_id=True,
-    )
-    return user_id
+def username_filter_key(username: str) -> str:
+    # the name as the username column's collation compares it: accents and case
+    # don't count, and neither do trailing spaces
+    decomposed = unicodedata.normalize("NFKD", username)
+    key = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return key.lower().rstrip(" ")
 
 
-async def create_profile_for_account(
-    user_id: int, username: str, bio: str, header_image_url: str
+def username_may_exist(username: str) -> bool:
+    if username_filter is None:
+        return True
+    key = username_filter_key(username)
+    # stored usernames are ascii. a key that is still not ascii may equal one
+    # under rules the folding above doesn't cover, e.g. ß which collations take
+    # for s or ss, so only the database can tell
+    if not key.isascii() or key in username_filter.bloom:
+        username_filter_maybes.inc()
+        return True
+    username_filter_misses.inc()
+    return False
+
+
+async def scan_usernames(
+    usernames: UsernameFilter, after_user_id: int, primary: bool = False
 ):
-    await insert_one(
-        DbName.USER,
-        "insert into profile (user_id, username, bio, header_image_url) values(%s, %s, %s, %s)",
+    async with aclosing(
+        stream(
+            DbName.USER,
+            "select `user_id`, `username` from `account` where `user_id` > %s",
+            (after_user_id,),
+            primary=primary,
+        )
+    ) as rows:
+        async for user_id, username in rows:
+            usernames.bloom.add(username_filter_key(username))
+            usernames.max_user_id = max(usernames.max_user_id, user_id)
+
+
+async def load_username_filter(capacity: int = USERNAME_FILTER_CAPACITY):
+    global username_filter
+    # built on the side and swapped in, lookups keep using the old filter meanwhile
+    usernames = UsernameFilter(BloomFilter(capacity, USERNAME_FILTER_ERROR_RATE))
+    await scan_usernames(usernames, 0)
+    username_filter = usernames
+
+
+async def refresh_username_filter():
+    bloom = username_filter.bloom
+    if bloom.count > bloom.capacity:
+        # past capacity the false positive rate climbs, so rebuild it bigger
+        await load_username_filter(bloom.capacity * 2)
+        return
+    # small scans, read from the primary so replica lag can't skip new accounts
+    await scan_usernames(
+        username_filter,
+        max(0, username_filter.max_user_id - USERNAME_FILTER_REFRESH_OVERLAP),
+        primary=True,
+    )
+
+
+async def run_username_filter_refresher():
+    while True:
+        await asyncio.sleep(USERNAME_FILTER_REFRESH)
+        try:
+            await refresh_username_filter()
+        except Exception:
+            traceback.print_exc()
+
+
+async def start_username_filter():
+    global username_filter_refresher
+    if not USERNAME_FILTER_REFRESH or username_filter_refresher is not None:
+        return
+    await load_username_filter()
+    username_filter_refresher = asyncio.create_task(run_username_filter_refresher())
+
+
+async def stop_username_filter():
+    global username_filter_refresher
+    if username_filter_refresher is not None:
+        username_filter_refresher.cancel()
+        try:
+            await username_filter_refresher
+        except asyncio.CancelledError:
+            pass
+        username_filter_refresher = None
+
+
+def collect_username_filter_metrics():
+    if username_filter is None:
+        return []
+    bloom = username_filter.bloom
+    return [
         (
-            user_id,
-            username,
-            bio,
-            header_image_url,
+            "username_filter_keys",
+            "Usernames in the filter",
+            "gauge",
+            [({}, bloom.count)],
         ),
-    )
+        (
+            "username_filter_capacity",
+            "Usernames the filter is sized for",
+            "gauge",
+            [({}, bloom.capacity)],
+        ),
+    ]
+
+
+register_collector(collect_username_filter_metrics)
@@ -0,0 +1,82 @@
+from os import getenv
+from typing import Any, TypeVar
+
+from aiohttp.web import Request
+from cattr import Converter
+from cattr.gen import make_dict_structure_fn
+from orjson import JSONDecodeError, loads
+
+from src.user.timing import span
+from src.user.util import InvalidRequest
+
+T = TypeVar("T")
+
+# bytes, for request types that weren't registered with their own limit
+REQUEST_MAX_BODY_SIZE = int(getenv("REQUEST_MAX_BODY_SIZE", 16 * 1024))
+
+# errors come out as the validator's InvalidRequest instead of being collected
+# into an exception group, which is also the faster path
+converter = Converter(detailed_validation=False)
+
+max_body_sizes: dict[type, int] = {}
+
+
+def structure_str(value: Any, cl: type[str]) -> str:
+    # the default hook would turn numbers, null, lists etc. into their str()
+    if not isinstance(value, str):
+        raise InvalidRequest("Invalid request")
+    # str enums like UploadImageRequest.ImageTypes dispatch here through their
+    # mro, a value that isn't a member raises ValueError
+    return value if cl is str else cl(value)
+
+
+# by type, function hooks would lose to the converter's own hook for str
+converter.register_structure_hook(str, structure_str)
+
+
+def set_max_body_sizes(max_sizes: dict[type, int]):
+    # request class -> max body size in bytes, checked before the body is read
+    max_body_sizes.update(max_sizes)
+
+
+def precompile_structure_hooks(*classes: type):
+    for cl in classes:
+        converter.register_structure_hook(
+            cl,
+            make_dict_structure_fn(cl, converter, _cattrs_detailed_validation=False),
+        )
+
+
+async def read_body(request: Request, max_size: int) -> bytes:
+    if request.content_length is not None and request.content_length > max_size:
+        raise InvalidRequest("Request body is too large", 413)
+    # chunked bodies have no length up front, stop reading once past the limit
+    body = bytearray()
+    while chunk := await request.content.read(max_size + 1 - len(body)):
+        body += chunk
+        if len(body) > max_size:
+            raise InvalidRequest("Request body is too large", 413)
+    return bytes(body)
+
+
+def decode_request(body: bytes, cl_type: type[T]) -> T:
+    try:
+        data = loads(body)
+    except JSONDecodeError:
+        raise InvalidRequest("Request body is not valid JSON")
+    if not isinstance(data, dict):
+        raise InvalidRequest("Invalid request")
+    try:
+        # validators on the request classes raise InvalidRequest with the message
+        return converter.structure(data, cl_type)
+    except KeyError as e:
+        raise InvalidRequest(f"Missing field {e.args[0]}")
+    except (TypeError, ValueError):
+        # wrong types, or a value that isn't in an enum
+        raise InvalidRequest("Invalid request")
+
+
+async def structure_request_body(request: Request, cl_type: type[T]) -> T:
+    body = await read_body(request, max_body_sizes.get(cl_type, REQUEST_MAX_BODY_SIZE))
+    with span("structure"):
+        return decode_request(body, cl_type)
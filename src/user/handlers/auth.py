@@ -1,18 +1,20 @@
 from aiohttp.web import Request, RouteTableDef
 from aiohttp_session import get_session, new_session
-from attr import define
+from attr import define, field
 
 from src.user.db_user import (
     AccountNotFound,
+    EmailTaken,
+    UsernameTaken,
     check_password,
-    create_profile_for_account,
-    create_user_account,
+    create_account_with_profile,
     encrypt_password,
     get_account_by_username,
-    get_user_id_by_username,
 )
+from src.user.decoding import structure_request_body
 from src.user.models import APIResponse
-from src.user.util import is_email_valid, is_username_valid, structure_request_body
+from src.user.ratelimit import check_rate_limit
+from src.user.util import is_email_valid, is_username_valid, validate_with
 
 from .handlers import api_route_get, api_route_put
 
@@ -37,9 +39,11 @@ class AuthenticateResponse:
 
 @define
 class CreateAccountRequest:
-    username: str
+    username: str = field(
+        validator=validate_with(is_username_valid, "Username is invalid")
+    )
     password: str
-    email: str
+    email: str = field(validator=validate_with(is_email_valid, "Email is invalid"))
 
 
 @define
@@ -63,6 +67,7 @@ async def authenticate(request: Request) -> APIResponse:
     req_data: AuthenticateRequest = await structure_request_body(
         request, AuthenticateRequest
     )
+    check_rate_limit("authenticate", request, req_data.username)
     try:
         user = await get_account_by_username(req_data.username)
     except AccountNotFound:
@@ -85,22 +90,17 @@ async def create_account(request: Request) -> APIResponse:
     req_data: CreateAccountRequest = await structure_request_body(
         request, CreateAccountRequest
     )
-
-    if not is_username_valid(req_data.username):
-        return APIResponse("Username is invalid")
-    if not is_email_valid(req_data.email):
-        return APIResponse("Email is invalid")
-
-    try:
-        user = await get_user_id_by_username(req_data.username)
-        if user:
-            return APIResponse("Username is taken. Please try again.", error=True)
-    except AccountNotFound:
-        pass
+    check_rate_limit("create_account", request, req_data.username)
 
     encrypted_pw = await encrypt_password(req_data.password)
-    user_id = await create_user_account(req_data.username, encrypted_pw, req_data.email)
-    await create_profile_for_account(user_id, req_data.username, "I'm new here!", "")
+    try:
+        user_id = await create_account_with_profile(
+            req_data.username, encrypted_pw, req_data.email, "I'm new here!", ""
+        )
+    except UsernameTaken:
+        return APIResponse("Username is taken. Please try again.", error=True)
+    except EmailTaken:
+        return APIResponse("Email is already in use.", error=True)
 
     session = await new_session(request)
     session["user_id"] = user_id
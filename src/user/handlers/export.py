@@ -0,0 +1,53 @@
+from contextlib import aclosing
+
+from aiohttp.web import Request, RouteTableDef, StreamResponse
+from orjson import dumps
+
+from src.user.db_feed import stream_comments_by_user_id, stream_posts_by_user_id
+from src.user.handlers.handlers import api_route_get, prepare_stream
+from src.user.models import UserSession
+from src.user.serialization import converter
+
+routes = RouteTableDef()
+
+# buffered lines are flushed to the client once they reach this many bytes
+EXPORT_WRITE_SIZE = 64 * 1024
+
+
+async def write_ndjson(resp: StreamResponse, record_type: str, records):
+    buffer = bytearray()
+    async with aclosing(records) as rows:
+        async for row in rows:
+            buffer += dumps({"type": record_type, **converter.unstructure(row)})
+            buffer += b"\n"
+            if len(buffer) >= EXPORT_WRITE_SIZE:
+                # waits for the client to drain, which bounds memory to one buffer
+                await resp.write(buffer)
+                buffer = bytearray()
+    if buffer:
+        await resp.write(buffer)
+
+
+@api_route_get(routes, "/account/export", auth=True)
+async def export_account(request: Request) -> StreamResponse:
+    sess: UserSession = request.get("session")
+
+    resp = StreamResponse(
+        headers={
+            "Content-Type": "application/x-ndjson",
+            "Content-Disposition": 'attachment; filename="export.ndjson"',
+        }
+    )
+    await prepare_stream(request, resp)
+
+    try:
+        await write_ndjson(resp, "post", stream_posts_by_user_id(sess.user_id))
+        await write_ndjson(resp, "comment", stream_comments_by_user_id(sess.user_id))
+        await resp.write_eof()
+    except Exception:
+        # the status line is out, so the client can only tell the export is
+        # incomplete by the connection ending without the final chunk
+        if request.transport is not None:
+            request.transport.close()
+        raise
+    return resp
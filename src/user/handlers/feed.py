@@ -5,15 +5,23 @@ from aiohttp.web import Request, RouteTableDef
 
 from src.common.upload_s3 import generate_presigned_url
 from src.user.db_feed import (
+    COMMENT_FETCH_LIMIT,
+    COMMENT_FETCH_MAX,
+    POST_FETCH_LIMIT,
+    POST_FETCH_MAX,
+    Post,
     PostComment,
     PostNotFound,
     are_posts_liked_by_user_id,
+    are_users_followed_by_user_id,
     create_comment,
     create_post,
     follow_user,
     get_comments_by_post_id,
     get_post_by_id,
+    get_posts_by_ids,
     get_posts_by_user_id,
+    get_timeline,
     is_post_liked_by_user_id,
     is_user_id_following_user_id,
     like_post,
@@ -22,15 +30,17 @@ from src.user.db_feed import (
     unlike_post,
 )
 from src.user.db_user import get_profiles_by_user_ids
-from src.user.handlers.handlers import api_route_delete, api_route_get, api_route_post
-from src.user.models import APIResponse, ProfileSummary, UserSession
-from src.user.util import (
-    COMMENT_TEXT_MAX_CHARS,
-    COMMENT_TEXT_MIN_CHARS,
-    POST_TEXT_MAX_CHARS,
-    POST_TEXT_MIN_CHARS,
-    structure_request_body,
+from src.user.decoding import structure_request_body
+from src.user.handlers.handlers import (
+    CachePolicy,
+    api_route_delete,
+    api_route_get,
+    api_route_post,
+    set_etag,
 )
+from src.user.models import APIResponse, ProfileSummary, UserSession
+from src.user.session import get_user_session
+from src.user.util import encode_cursor, get_page_params, get_query_ids
 
 from .models.feed import (
     Comment,
@@ -43,7 +53,19 @@ from .models.feed import (
 routes = RouteTableDef()
 
 
-@api_route_get(routes, "/post/{id}")
+def post_etag_parts(post: Post) -> tuple:
+    # posts can't be edited, so only the counters and viewer-dependent fields change
+    return (
+        post.post_id,
+        post.num_comments,
+        post.num_likes,
+        post.num_shares,
+        post.is_liked,
+        post.username,
+    )
+
+
+@api_route_get(routes, "/post/{id}", cache=CachePolicy(max_age=5, personalized=True))
 async def get_post(request: Request) -> APIResponse:
     post_id = int(request.match_info.get("id"))
 
@@ -51,24 +73,18 @@ async def get_post(request: Request) -> APIResponse:
         post = await get_post_by_id(post_id)
     except PostNotFound:
         return APIResponse("Post not found", error=True)
-    if sess := request.get("session"):
+    if sess := await get_user_session(request):
         post.is_liked = await is_post_liked_by_user_id(post_id, sess.user_id)
+    set_etag(request, post_etag_parts(post))
     return APIResponse({"post": post})
 
 
-@api_route_get(routes, "/user/{id}/posts")
-async def get_posts(request: Request) -> APIResponse:
-    user_id = int(request.match_info.get("id"))
-    try:
-        posts = await get_posts_by_user_id(user_id)
-    except PostNotFound:
-        return APIResponse("Posts not found", error=True)
-
+async def hydrate_posts(request: Request, posts: list[Post]):
     user_ids = {post.user_id for post in posts}
     user_profiles = await get_profiles_by_user_ids(user_ids)
 
     posts_liked = tuple()
-    if sess := request.get("session"):
+    if sess := await get_user_session(request):
         post_ids = [post.post_id for post in posts]
         if post_ids:
             posts_liked = await are_posts_liked_by_user_id(post_ids, sess.user_id)
@@ -78,7 +94,53 @@ async def get_posts(request: Request) -> APIResponse:
             post.is_liked = True
         post.username = user_profiles.get(post.user_id).username
 
-    return APIResponse({"posts": posts})
+
+def next_post_cursor(posts: list[Post], limit: int) -> str | None:
+    if len(posts) < limit:
+        return None
+    return encode_cursor(posts[-1].date, posts[-1].post_id)
+
+
+@api_route_get(
+    routes, "/user/{id}/posts", cache=CachePolicy(max_age=5, personalized=True)
+)
+async def get_posts(request: Request) -> APIResponse:
+    user_id = int(request.match_info.get("id"))
+    cursor, limit = get_page_params(request, POST_FETCH_LIMIT, POST_FETCH_MAX)
+    try:
+        posts = await get_posts_by_user_id(user_id, cursor, limit)
+    except PostNotFound:
+        return APIResponse("Posts not found", error=True)
+
+    await hydrate_posts(request, posts)
+    next_cursor = next_post_cursor(posts, limit)
+    set_etag(request, next_cursor, *(post_etag_parts(post) for post in posts))
+    return APIResponse({"posts": posts, "next_cursor": next_cursor})
+
+
+@api_route_get(routes, "/feed", auth=True)
+async def get_feed(request: Request) -> APIResponse:
+    sess: UserSession = request.get("session")
+    cursor, limit = get_page_params(request, POST_FETCH_LIMIT, POST_FETCH_MAX)
+
+    posts = await get_timeline(sess.user_id, cursor, limit)
+    await hydrate_posts(request, posts)
+    return APIResponse({"posts": posts, "next_cursor": next_post_cursor(posts, limit)})
+
+
+@api_route_get(routes, "/posts", cache=CachePolicy(max_age=5, personalized=True))
+async def get_posts_bulk(request: Request) -> APIResponse:
+    post_ids = get_query_ids(request, "ids")
+    if not post_ids:
+        return APIResponse({"posts": [], "missing": []})
+
+    found = await get_posts_by_ids(post_ids)
+    posts = [found[post_id] for post_id in post_ids if post_id in found]
+    missing = [post_id for post_id in post_ids if post_id not in found]
+
+    await hydrate_posts(request, posts)
+    set_etag(request, missing, *(post_etag_parts(post) for post in posts))
+    return APIResponse({"posts": posts, "missing": missing})
 
 
 @api_route_post(routes, "/post/{id}/like", auth=True)
@@ -113,6 +175,24 @@ async def is_following(request: Request) -> APIResponse:
     return APIResponse({"following": is_following_resp})
 
 
+@api_route_get(routes, "/status", auth=True)
+async def get_status_bulk(request: Request) -> APIResponse:
+    sess: UserSession = request.get("session")
+    post_ids = get_query_ids(request, "post_ids")
+    user_ids = get_query_ids(request, "user_ids")
+
+    liked = await are_posts_liked_by_user_id(post_ids, sess.user_id) if post_ids else ()
+    following = (
+        await are_users_followed_by_user_id(user_ids, sess.user_id) if user_ids else ()
+    )
+    return APIResponse(
+        {
+            "liked": [post_id for post_id in post_ids if post_id in liked],
+            "following": [user_id for user_id in user_ids if user_id in following],
+        }
+    )
+
+
 @api_route_post(routes, "/user/{id}/follow", auth=True)
 async def follow_user_req(request: Request) -> APIResponse:
 
@@ -146,12 +226,6 @@ async def create_feed_post(request: Request) -> APIResponse:
     )
     sess: UserSession = request.get("session")
 
-    if not (POST_TEXT_MIN_CHARS <= len(req_data.text) <= POST_TEXT_MAX_CHARS):
-        return APIResponse(
-            f"Your post should be between {POST_TEXT_MIN_CHARS} and {POST_TEXT_MAX_CHARS} characters",
-            error=True,
-        )
-
     post_id = await create_post(sess.user_id, req_data.text)
     return APIResponse({"post_id": post_id})
 
@@ -179,14 +253,13 @@ async def upload_image(request: Request) -> APIResponse:
 @api_route_get(routes, "/post/{id}/comments")
 async def get_post_comments(request: Request) -> APIResponse:
     post_id = int(request.match_info.get("id"))
-    try:
-        last_id = int(request.query.get("last_id"))
-    except TypeError:
-        last_id = None
+    # the first fetch for a post only displays the most recent comment
+    default_limit = COMMENT_FETCH_LIMIT if "cursor" in request.query else 1
+    cursor, limit = get_page_params(request, default_limit, COMMENT_FETCH_MAX)
 
-    comments = await get_comments_by_post_id(post_id, last_id)
+    comments = await get_comments_by_post_id(post_id, cursor, limit)
     if not comments:
-        return APIResponse({"comments": []})
+        return APIResponse({"comments": [], "next_cursor": None})
 
     user_profiles = await get_profiles_by_user_ids(
         {comment.user_id for comment in comments}
@@ -204,7 +277,10 @@ async def get_post_comments(request: Request) -> APIResponse:
         for comment in comments
     ]
 
-    return APIResponse({"comments": converted_comments})
+    next_cursor = None
+    if len(comments) == limit:
+        next_cursor = encode_cursor(comments[-1].date, comments[-1].comment_id)
+    return APIResponse({"comments": converted_comments, "next_cursor": next_cursor})
 
 
 @api_route_post(routes, "/post/{post_id}/comments", auth=True)
@@ -215,12 +291,6 @@ async def create_post_comment(request: Request) -> APIResponse:
     )
     sess: UserSession = request.get("session")
 
-    if not (COMMENT_TEXT_MIN_CHARS <= len(req_data.text) <= COMMENT_TEXT_MAX_CHARS):
-        return APIResponse(
-            f"Your comment should be between {COMMENT_TEXT_MIN_CHARS} and {COMMENT_TEXT_MAX_CHARS} characters",
-            error=True,
-        )
-
     comment_id = await create_comment(post_id, sess.user_id, req_data.text)
     return APIResponse({"comment_id": comment_id})
 
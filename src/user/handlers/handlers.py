@@ -1,55 +1,187 @@
 import traceback
+from asyncio import CancelledError
 from functools import wraps
+from hashlib import blake2b
+from math import ceil
+from time import perf_counter
+
+from aiohttp.web import Request, Response, RouteTableDef, StreamResponse
+from attr import define
+
+from src.user.db import READ_YOUR_WRITES_WINDOW
+from src.user.hashing import PasswordHashBusy
+from src.user.models import APIResponse
+from src.user.ratelimit import RateLimited
+from src.user.serialization import json_response
+from src.user.session import USER_SESSION_KEY, get_user_session
+from src.user.timing import (
+    SERVER_TIMING,
+    SLOW_REQUEST_THRESHOLD,
+    Timings,
+    request_timings,
+    route_profiler,
+    span,
+    timing_enabled,
+)
+from src.user.util import InvalidRequest
 
-from aiohttp.web import RouteTableDef, json_response
-from aiohttp_session import get_session
-from cattr import unstructure
+ETAG_KEY = "etag"
+STREAM_RESPONSE_KEY = "stream_response"
+
+
+@define
+class CachePolicy:
+    max_age: int = 0
+    # the body depends on who is asking (e.g. is_liked), so signed in users get a
+    # private response and shared caches have to key on the cookie
+    personalized: bool = False
+    # false for responses that should never sit in a shared cache
+    public: bool = True
+
+
+def set_etag(request: Request, *parts):
+    # parts should be cheap values that change whenever the body does, like ids,
+    # counters and flags, rather than the serialized body itself
+    digest = blake2b(repr(parts).encode("utf-8"), digest_size=12).hexdigest()
+    request[ETAG_KEY] = f'"{digest}"'
+
+
+async def prepare_stream(request: Request, resp: StreamResponse):
+    # lets the api_response wrapper know the status line is already out
+    request[STREAM_RESPONSE_KEY] = resp
+    await resp.prepare(request)
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
 
-from src.user.models import APIResponse, UserSession
-from src.user.util import InvalidRequest
+
+def cache_headers(request: Request, cache: CachePolicy) -> dict[str, str]:
+    private = not cache.public or (
+        cache.personalized and request.get(USER_SESSION_KEY) is not None
+    )
+    scope = "private" if private else "public"
+    directive = f"max-age={cache.max_age}" if cache.max_age else "no-cache"
+    headers = {"Cache-Control": f"{scope}, {directive}"}
+    if cache.personalized:
+        headers["Vary"] = "Cookie"
+    return headers
 
 
 # wrap APIResponse and convert to aiohttp.web.Response
 def api_response(
-    route_table: RouteTableDef, method: str, path: str, auth: bool = False
+    route_table: RouteTableDef,
+    method: str,
+    path: str,
+    auth: bool = False,
+    cache: CachePolicy | None = None,
 ):
     def wrapper(handler):
-        @wraps(handler)
-        async def wrapped(request):
+        async def respond(request: Request) -> StreamResponse:
             status = 200
 
-            # check for session to add to request locals
-            sess = await get_session(request)
-            logged_in = False
-            if sess and (user_id := sess.get("user_id")):
-                logged_in = True
-                request["session"] = UserSession(user_id, sess.get("username"))
+            # public routes only load the session when the handler asks for it, unless
+            # reads need to know the user to stay on the primary after their writes
+            if auth or READ_YOUR_WRITES_WINDOW:
+                user_session = await get_user_session(request)
 
-            # if auth is required, check and send 401 if applicable
-            if auth and not logged_in:
-                return json_response(data={"message": "Not authenticated"}, status=401)
+                # if auth is required, check and send 401 if applicable
+                if auth and not user_session:
+                    return json_response({"message": "Not authenticated"}, status=401)
             try:
-                resp: APIResponse = await handler(request)
-            except InvalidRequest:
-                status = 400
-                resp = APIResponse("Invalid request", success=False, error=True)
-                resp_dict = unstructure(resp)
-                return json_response(data=resp_dict, status=status)
+                with span("handler"):
+                    resp: APIResponse = await handler(request)
+            except InvalidRequest as e:
+                status = e.status
+                resp = APIResponse(e.error, success=False, error=True)
+                return json_response(resp, status=status)
+
+            except RateLimited as e:
+                status = 429
+                resp = APIResponse(e.error, success=False, error=True)
+                return json_response(
+                    resp,
+                    status=status,
+                    headers={"Retry-After": str(ceil(e.retry_after))},
+                )
+
+            except PasswordHashBusy:
+                # shed load instead of queueing more bcrypt work behind a burst
+                status = 503
+                resp = APIResponse(
+                    "Server is busy, please try again", success=False, error=True
+                )
+                return json_response(resp, status=status, headers={"Retry-After": "1"})
 
             except Exception as e:
+                stream = request.get(STREAM_RESPONSE_KEY)
+                if stream is not None and stream.prepared:
+                    # a second response can't be written into one that started,
+                    # aiohttp closes the connection instead
+                    if isinstance(e, ConnectionResetError):
+                        # the client went away, nothing went wrong on our side
+                        raise CancelledError()
+                    raise
                 # print traceback even though we are catching error
                 traceback.print_exc()
                 status = 500
                 resp = APIResponse(str(e), success=False, error=True)
-                resp_dict = unstructure(resp)
-                return json_response(data=resp_dict, status=status)
+                return json_response(resp, status=status)
+
+            # streaming handlers write their own body
+            if isinstance(resp, StreamResponse):
+                return resp
 
             if resp.error:
                 resp.success = False
                 resp.response = {"message": resp.response}
+                return json_response(resp, status=status)
+
+            if cache:
+                headers = cache_headers(request, cache)
+                if etag := request.get(ETAG_KEY):
+                    headers["ETag"] = etag
+                    if etag_matches(request.headers.get("If-None-Match"), etag):
+                        return Response(status=304, headers=headers)
+                return json_response(resp, status=status, headers=headers)
+
+            return json_response(resp, status=status)
 
-            resp_dict = unstructure(resp)
-            return json_response(data=resp_dict, status=status)
+        profiler = route_profiler(method.upper(), path)
+
+        @wraps(handler)
+        async def wrapped(request: Request) -> StreamResponse:
+            if not timing_enabled and profiler is None:
+                return await respond(request)
+
+            timings = Timings(perf_counter())
+            token = request_timings.set(timings)
+            profile = profiler.start() if profiler else None
+            try:
+                resp = await respond(request)
+            finally:
+                if profile:
+                    profiler.finish(profile)
+                request_timings.reset(token)
+
+            if SERVER_TIMING and not resp.prepared:
+                resp.headers["Server-Timing"] = timings.server_timing()
+            if (
+                SLOW_REQUEST_THRESHOLD
+                and (total := timings.total()) > SLOW_REQUEST_THRESHOLD
+            ):
+                print(
+                    f"Slow request {request.method} {request.path} {total * 1000:.1f}ms "
+                    f"{timings.describe()}"
+                )
+            return resp
 
         getattr(route_table, method)(path)(wrapped)
         return wrapped
@@ -57,8 +189,13 @@ def api_response(
     return wrapper
 
 
-def api_route_get(route_table: RouteTableDef, path: str, auth: bool = False):
-    return api_response(route_table, "get", path, auth)
+def api_route_get(
+    route_table: RouteTableDef,
+    path: str,
+    auth: bool = False,
+    cache: CachePolicy | None = None,
+):
+    return api_response(route_table, "get", path, auth, cache)
 
 
 def api_route_post(route_table: RouteTableDef, path: str, auth: bool = False):
@@ -0,0 +1,21 @@
+from aiohttp.web import Request, Response, RouteTableDef
+
+from src.user.lifecycle import check_ready
+from src.user.serialization import json_response
+
+# plain routes, probes shouldn't touch sessions or go through the api_response wrapper
+routes = RouteTableDef()
+
+
+@routes.get("/healthz")
+async def healthz(request: Request) -> Response:
+    return json_response({"status": "ok"})
+
+
+@routes.get("/readyz")
+async def readyz(request: Request) -> Response:
+    # ready once the pools are warm, until draining starts, and while the
+    # databases answer
+    if await check_ready():
+        return json_response({"status": "ready"})
+    return json_response({"status": "not ready"}, status=503)
@@ -0,0 +1,14 @@
+from aiohttp.web import Request, Response, RouteTableDef
+
+from src.user.metrics import render
+
+routes = RouteTableDef()
+
+
+@routes.get("/metrics")
+async def metrics(request: Request) -> Response:
+    # every worker process keeps its own metrics
+    return Response(
+        body=render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
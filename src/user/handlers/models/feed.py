@@ -1,8 +1,15 @@
 from enum import Enum, unique
 
-from attr import define
+from attr import define, field
 
 from ...models import ProfileSummary
+from ...util import (
+    COMMENT_TEXT_MAX_CHARS,
+    COMMENT_TEXT_MIN_CHARS,
+    POST_TEXT_MAX_CHARS,
+    POST_TEXT_MIN_CHARS,
+    validate_length,
+)
 
 
 @define
@@ -24,7 +31,13 @@ class UploadImageResponse:
 
 @define
 class CreatePostRequest:
-    text: str
+    text: str = field(
+        validator=validate_length(
+            POST_TEXT_MIN_CHARS,
+            POST_TEXT_MAX_CHARS,
+            f"Your post should be between {POST_TEXT_MIN_CHARS} and {POST_TEXT_MAX_CHARS} characters",
+        )
+    )
 
 
 @define
@@ -37,4 +50,10 @@ class Comment:
 
 @define
 class CreateCommentRequest:
-    text: str
+    text: str = field(
+        validator=validate_length(
+            COMMENT_TEXT_MIN_CHARS,
+            COMMENT_TEXT_MAX_CHARS,
+            f"Your comment should be between {COMMENT_TEXT_MIN_CHARS} and {COMMENT_TEXT_MAX_CHARS} characters",
+        )
+    )
@@ -1,20 +1,31 @@
 from aiohttp.web import Request, RouteTableDef
-from attr import define
+from attr import define, field
 
 from src.user.db_user import (
     AccountNotFound,
+    Profile,
     get_account_by_id,
-    get_profile_by_user_id,
-    get_user_id_by_username,
+    get_profile_by_account_username,
+    get_profiles_by_user_ids,
+    get_profiles_by_usernames,
     update_user_profile,
 )
-from src.user.handlers.handlers import api_route_get, api_route_put
+from src.user.decoding import structure_request_body
+from src.user.handlers.handlers import (
+    CachePolicy,
+    api_route_get,
+    api_route_put,
+    set_etag,
+)
 from src.user.models import APIResponse, UserSession
 from src.user.util import (
     BIO_MAX_CHARS,
     DISPLAY_NAME_MAX_CHARS,
+    get_query_ids,
+    get_query_list,
     is_upload_url_key_valid,
-    structure_request_body,
+    validate_length,
+    validate_with,
 )
 
 routes = RouteTableDef()
@@ -22,32 +33,73 @@ routes = RouteTableDef()
 
 @define
 class UpdateProfileRequest:
-    bio: str
-    display_name: str
-    header_image_url: str
+    bio: str = field(
+        validator=validate_length(
+            0, BIO_MAX_CHARS, f"Bio should be {BIO_MAX_CHARS} characters or less"
+        )
+    )
+    display_name: str = field(
+        validator=validate_length(
+            0,
+            DISPLAY_NAME_MAX_CHARS,
+            f"Display name should be {DISPLAY_NAME_MAX_CHARS} characters or less",
+        )
+    )
+    header_image_url: str = field(
+        validator=validate_with(
+            is_upload_url_key_valid, "Invalid profile header. Please try again."
+        )
+    )
+
+
+def profile_etag_parts(profile: Profile) -> tuple:
+    return (
+        profile.user_id,
+        profile.username,
+        profile.bio,
+        profile.header_image_url,
+        profile.following_count,
+        profile.follower_count,
+    )
 
 
-@api_route_get(routes, "/user/{id}")
+@api_route_get(routes, "/user/{id}", cache=CachePolicy(max_age=30, public=False))
 async def get_user(request: Request) -> APIResponse:
     user_id = int(request.match_info.get("id"))
     try:
         user = await get_account_by_id(user_id)
     except AccountNotFound:
         return APIResponse("User not found", error=True)
+    set_etag(request, user.user_id, user.username, user.password, user.email_address)
     return APIResponse({"user": user})
 
 
-@api_route_get(routes, "/profile/{username}")
+@api_route_get(routes, "/profile/{username}", cache=CachePolicy(max_age=30))
 async def get_profile(request: Request) -> APIResponse:
     username = str(request.match_info.get("username"))
     try:
-        user_id = await get_user_id_by_username(username)
+        profile = await get_profile_by_account_username(username)
     except AccountNotFound:
         return APIResponse("User not found", error=True)
-    profile = await get_profile_by_user_id(user_id)
+    set_etag(request, profile_etag_parts(profile))
     return APIResponse({"profile": profile})
 
 
+@api_route_get(routes, "/profiles", cache=CachePolicy(max_age=30))
+async def get_profiles_bulk(request: Request) -> APIResponse:
+    if usernames := get_query_list(request, "usernames"):
+        found = await get_profiles_by_usernames(set(usernames))
+        keys = usernames
+    else:
+        keys = get_query_ids(request, "ids")
+        found = await get_profiles_by_user_ids(set(keys)) if keys else {}
+
+    profiles = [found[key] for key in keys if key in found]
+    missing = [key for key in keys if key not in found]
+    set_etag(request, missing, *(profile_etag_parts(profile) for profile in profiles))
+    return APIResponse({"profiles": profiles, "missing": missing})
+
+
 @api_route_put(routes, "/user/profile", auth=True)
 async def update_profile(request: Request) -> APIResponse:
     req_data: UpdateProfileRequest = await structure_request_body(
@@ -55,20 +107,6 @@ async def update_profile(request: Request) -> APIResponse:
     )
     sess: UserSession = request.get("session")
 
-    if len(req_data.bio) > BIO_MAX_CHARS:
-        return APIResponse(
-            f"Bio should be {BIO_MAX_CHARS} characters or less", error=True
-        )
-
-    if len(req_data.display_name) > DISPLAY_NAME_MAX_CHARS:
-        return APIResponse(
-            f"Display name should be {DISPLAY_NAME_MAX_CHARS} characters or less",
-            error=True,
-        )
-
-    if not is_upload_url_key_valid(req_data.header_image_url):
-        return APIResponse("Invalid profile header. Please try again.", error=True)
-
     await update_user_profile(
         sess.user_id, req_data.display_name, req_data.bio, req_data.header_image_url
     )
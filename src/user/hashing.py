@@ -0,0 +1,110 @@
+import asyncio
+from asyncio import get_running_loop, wait_for, wrap_future
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count, getenv
+from time import monotonic
+from typing import Callable, TypeVar
+
+from attr import define
+
+from src.user.metrics import counter, histogram, register_collector
+from src.user.timing import add_span
+
+T = TypeVar("T")
+
+# bcrypt releases the GIL while it hashes, so threads run hashes in parallel and
+# a process pool would only add pickling and IPC
+PASSWORD_HASH_WORKERS = int(getenv("PASSWORD_HASH_WORKERS", cpu_count() or 1))
+# hashes allowed to wait for a worker, anything past this is rejected right away
+PASSWORD_HASH_QUEUE = int(getenv("PASSWORD_HASH_QUEUE", 64))
+# seconds a hash may wait for a worker before the request gives up on it
+PASSWORD_HASH_WAIT = float(getenv("PASSWORD_HASH_WAIT", 1))
+
+
+@define
+class PasswordHashBusy(Exception):
+    error: str
+
+
+executor = ThreadPoolExecutor(PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+# admission happens on the event loop, the executor never has more jobs than
+# workers so nothing queues up inside it where it can't be rejected or timed out
+slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+waiting = 0
+busy = 0
+
+hash_seconds = histogram(
+    "password_hash_seconds", "Time spent hashing or checking a password", ("op",)
+)
+hash_wait_seconds = histogram(
+    "password_hash_wait_seconds", "Time spent waiting for a hashing worker"
+).labels()
+hash_rejected = counter(
+    "password_hash_rejected_total", "Hashes rejected by admission control", ("reason",)
+)
+
+
+async def run_password_hash(op: str, fn: Callable[..., T], *args) -> T:
+    global waiting, busy
+    started = monotonic()
+    if not slots.locked():
+        # a free worker, acquire returns without suspending
+        await slots.acquire()
+    elif waiting >= PASSWORD_HASH_QUEUE:
+        hash_rejected.labels("queue_full").inc()
+        raise PasswordHashBusy("Password hashing queue is full")
+    else:
+        waiting += 1
+        try:
+            await wait_for(slots.acquire(), PASSWORD_HASH_WAIT)
+        except asyncio.TimeoutError:
+            hash_rejected.labels("deadline").inc()
+            raise PasswordHashBusy("Timed out waiting for a password hashing worker")
+        finally:
+            waiting -= 1
+    waited = monotonic() - started
+    hash_wait_seconds.observe(waited)
+    add_span("hash_wait", waited)
+
+    busy += 1
+    loop = get_running_loop()
+    started = monotonic()
+    job = executor.submit(fn, *args)
+    # the slot is freed when the thread is done, not when the request stops
+    # waiting, so a cancelled request can't let more hashes run than workers
+    job.add_done_callback(lambda _: loop.call_soon_threadsafe(release_slot))
+    result = await wrap_future(job)
+    elapsed = monotonic() - started
+    hash_seconds.labels(op).observe(elapsed)
+    add_span("hash", elapsed)
+    return result
+
+
+def release_slot():
+    global busy
+    busy -= 1
+    slots.release()
+
+
+def collect_hash_metrics():
+    return [
+        (
+            "password_hash_queue_depth",
+            "Hashes waiting for a worker",
+            "gauge",
+            [({}, waiting)],
+        ),
+        (
+            "password_hash_workers_busy",
+            "Hashing workers in use",
+            "gauge",
+            [({}, busy)],
+        ),
+    ]
+
+
+register_collector(collect_hash_metrics)
+
+
+def shutdown_hash_pool():
+    executor.shutdown(wait=False, cancel_futures=True)
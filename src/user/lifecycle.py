@@ -0,0 +1,98 @@
+import asyncio
+from os import getenv
+
+from aiohttp import web
+from attr import define
+
+from src.common.upload_s3 import init_s3
+from src.user.db import (
+    DbName,
+    close_pools,
+    create_pool,
+    ping,
+    start_replica_monitor,
+    warm_pool,
+)
+from src.user.db_feed import COMMENT_DB_KEYS
+from src.user.db_user import (
+    ACCOUNT_DB_KEYS,
+    PROFILE_DB_KEYS,
+    start_username_filter,
+    stop_username_filter,
+)
+from src.user.hashing import shutdown_hash_pool
+from src.user.tasks.supervisor import drain_tasks, start_tasks
+from src.user.tasks.update_post_counts import (
+    start_post_count_flusher,
+    stop_post_count_flusher,
+)
+
+# seconds /readyz reports not ready before the listener is closed, so the load
+# balancer stops sending new connections before they'd be refused
+DRAIN_DELAY = float(getenv("DRAIN_DELAY", 0))
+
+# run once per server at startup so the first requests don't pay for cold table
+# and index pages
+WARMUP_QUERIES: dict[DbName, tuple[str, ...]] = {
+    DbName.USER: (
+        f"select {ACCOUNT_DB_KEYS} from `account` limit 1",
+        f"select {PROFILE_DB_KEYS} from `profile` limit 1",
+    ),
+    DbName.FEED: (
+        "select `post_id` from `post` where `post_id` = 0",
+        f"select {COMMENT_DB_KEYS} from `post_comment` limit 1",
+        "select `user_id`, `post_id` from `post_like` limit 1",
+        "select `following_id` from `following` limit 1",
+        "select `post_id` from `timeline` limit 1",
+    ),
+}
+
+
+@define
+class Lifecycle:
+    ready: bool = False
+    draining: bool = False
+
+
+lifecycle = Lifecycle()
+
+
+async def on_startup(app: web.Application):
+    for db_name in DbName:
+        await create_pool(db_name, app["workers"])
+        await warm_pool(db_name, WARMUP_QUERIES[db_name])
+    start_replica_monitor()
+    await start_username_filter()
+    start_post_count_flusher()
+    start_tasks()
+    init_s3()
+    lifecycle.ready = True
+
+
+async def begin_drain():
+    # the listener is still open here, requests are served as usual
+    lifecycle.ready = False
+    if DRAIN_DELAY:
+        await asyncio.sleep(DRAIN_DELAY)
+
+
+async def on_shutdown(app: web.Application):
+    # the listener is closed, requests already running get the site's
+    # shutdown_timeout to finish while new ones on kept-alive connections get a 503
+    lifecycle.ready = False
+    lifecycle.draining = True
+
+
+async def on_cleanup(app: web.Application):
+    # no requests are running anymore, so nothing new can be queued
+    await drain_tasks()
+    await stop_post_count_flusher()
+    await stop_username_filter()
+    await close_pools()
+    shutdown_hash_pool()
+
+
+async def check_ready() -> bool:
+    if not lifecycle.ready:
+        return False
+    return all(await asyncio.gather(*(ping(db_name) for db_name in DbName)))
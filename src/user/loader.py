@@ -0,0 +1,110 @@
+import asyncio
+from contextvars import Context
+from os import getenv
+from time import perf_counter
+from typing import Awaitable, Callable, Generic, Hashable, Iterable, TypeVar
+
+from src.user.timing import add_span
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+LOADER_MAX_BATCH = int(getenv("LOADER_MAX_BATCH", 100))
+# 0 dispatches at the end of the current event loop tick
+LOADER_MAX_WAIT = float(getenv("LOADER_MAX_WAIT_MS", 0)) / 1000
+
+
+def add_batch_span(started: float):
+    # batches run in no request's context, so their db spans aren't recorded.
+    # each request waiting on one is charged the time it waited instead
+    add_span("db_batch", perf_counter() - started)
+
+
+# coalesces keyed lookups from concurrent requests into batched calls to batch_fn,
+# which takes a list of keys and returns a dict of the keys it found. keys that are
+# already pending or in flight share the same lookup. batches run outside of any
+# request's context, requests for which bypass() is true call batch_fn themselves
+class BatchLoader(Generic[K, V]):
+    def __init__(
+        self,
+        batch_fn: Callable[[list[K]], Awaitable[dict[K, V]]],
+        max_batch: int = LOADER_MAX_BATCH,
+        max_wait: float = LOADER_MAX_WAIT,
+        bypass: Callable[[], bool] | None = None,
+    ):
+        self.batch_fn = batch_fn
+        self.bypass = bypass
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending: dict[K, asyncio.Future] = {}
+        self.in_flight: dict[K, asyncio.Future] = {}
+        self.dispatch_handle: asyncio.Handle | None = None
+        self.tasks: set[asyncio.Task] = set()
+
+    def enqueue(self, key: K) -> asyncio.Future:
+        if fut := self.pending.get(key) or self.in_flight.get(key):
+            return fut
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending[key] = fut
+        if len(self.pending) >= self.max_batch:
+            self.dispatch()
+        elif self.dispatch_handle is None:
+            if self.max_wait:
+                self.dispatch_handle = loop.call_later(self.max_wait, self.dispatch)
+            else:
+                self.dispatch_handle = loop.call_soon(self.dispatch)
+        return fut
+
+    async def load(self, key: K) -> V | None:
+        if self.bypass and self.bypass():
+            return (await self.batch_fn([key])).get(key)
+        started = perf_counter()
+        # shield so one cancelled request doesn't cancel the lookup for everyone
+        value = await asyncio.shield(self.enqueue(key))
+        add_batch_span(started)
+        return value
+
+    async def load_many(self, keys: Iterable[K]) -> dict[K, V]:
+        keys = list(dict.fromkeys(keys))
+        if self.bypass and self.bypass():
+            return await self.batch_fn(keys) if keys else {}
+        started = perf_counter()
+        values = await asyncio.gather(
+            *(asyncio.shield(self.enqueue(key)) for key in keys)
+        )
+        add_batch_span(started)
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def dispatch(self):
+        if self.dispatch_handle:
+            self.dispatch_handle.cancel()
+            self.dispatch_handle = None
+
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        self.in_flight.update(batch)
+        # a task copies the current context, which here is whichever request's
+        # enqueue scheduled the dispatch. an empty one keeps its ContextVars, like
+        # the user id and timings, from applying to everyone else's keys
+        task = Context().run(asyncio.create_task, self.run(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: dict[K, asyncio.Future]):
+        try:
+            results = await self.batch_fn(list(batch))
+        except Exception as e:
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(e)
+        else:
+            for key, fut in batch.items():
+                if not fut.done():
+                    fut.set_result(results.get(key))
+        finally:
+            for key, fut in batch.items():
+                if self.in_flight.get(key) is fut:
+                    del self.in_flight[key]
@@ -0,0 +1,148 @@
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from attr import define, field
+
+# seconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+ROW_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+@define
+class Counter:
+    value: float = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+@define
+class Histogram:
+    buckets: tuple[float, ...]
+    # one slot per bucket plus +Inf, allocated once so observe never allocates
+    counts: list[int] = field(init=False)
+    sum: float = 0.0
+    count: int = 0
+
+    def __attrs_post_init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        # buckets are upper bounds and inclusive, like Prometheus' le
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+@define
+class Metric:
+    name: str
+    help: str
+    type: str
+    label_names: tuple[str, ...]
+    buckets: tuple[float, ...] = ()
+    children: dict[tuple, Counter | Histogram] = field(factory=dict)
+
+    def labels(self, *values) -> Counter | Histogram:
+        # callers on hot paths should keep the child instead of looking it up
+        # for every observation
+        child = self.children.get(values)
+        if child is None:
+            if self.type == "histogram":
+                child = Histogram(self.buckets)
+            else:
+                child = Counter()
+            self.children[values] = child
+        return child
+
+
+# (name, help, type, [(labels, value)]) for values that are read at scrape time
+Sample = tuple[str, str, str, list[tuple[dict[str, str], float]]]
+
+metrics: dict[str, Metric] = {}
+collectors: list[Callable[[], Iterable[Sample]]] = []
+
+
+def counter(name: str, help: str, label_names: tuple[str, ...] = ()) -> Metric:
+    return metrics.setdefault(name, Metric(name, help, "counter", label_names))
+
+
+def histogram(
+    name: str,
+    help: str,
+    label_names: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = LATENCY_BUCKETS,
+) -> Metric:
+    return metrics.setdefault(
+        name, Metric(name, help, "histogram", label_names, buckets)
+    )
+
+
+def register_collector(collect: Callable[[], Iterable[Sample]]):
+    collectors.append(collect)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    # Prometheus text exposition format 0.0.4
+    lines = []
+    for metric in metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for values, child in metric.children.items():
+            labels = dict(zip(metric.label_names, values))
+            if isinstance(child, Counter):
+                lines.append(
+                    f"{metric.name}{format_labels(labels)} {format_value(child.value)}"
+                )
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(
+                metric.buckets + (float("inf"),), child.counts
+            ):
+                cumulative += bucket_count
+                bucket_labels = format_labels({**labels, "le": format_value(bound)})
+                lines.append(f"{metric.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(
+                f"{metric.name}_sum{format_labels(labels)} {format_value(child.sum)}"
+            )
+            lines.append(f"{metric.name}_count{format_labels(labels)} {child.count}")
+
+    for collect in collectors:
+        for name, help, metric_type, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+    lines.append("")
+    return "\n".join(lines)
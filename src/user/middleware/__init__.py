@@ -1,3 +1,8 @@
 from .api_response import api_response
+from .compression import compress_response
+from .drain import reject_when_draining
+from .metrics import record_metrics
 
-middlewares = [api_response]
+# outermost first, compression sees the final response of every other layer and
+# the request metrics include the time spent compressing
+middlewares = [record_metrics, compress_response, reject_when_draining, api_response]
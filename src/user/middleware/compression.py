@@ -0,0 +1,131 @@
+import zlib
+from asyncio import get_running_loop
+from functools import lru_cache
+from os import getenv
+from typing import Callable
+
+from aiohttp import hdrs
+from aiohttp.web import Request, Response, StreamResponse, middleware
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bodies smaller than this are sent as is, compressing them costs more CPU than
+# the bytes saved are worth
+COMPRESS_MIN_SIZE = int(getenv("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_LEVEL = int(getenv("COMPRESS_LEVEL", 6))
+COMPRESS_ZSTD_LEVEL = int(getenv("COMPRESS_ZSTD_LEVEL", 3))
+# bodies at least this big are compressed in the default executor instead of
+# blocking the event loop, zlib and zstd release the GIL while they work
+COMPRESS_EXECUTOR_SIZE = int(getenv("COMPRESS_EXECUTOR_SIZE", 64 * 1024))
+
+COMPRESSIBLE_TYPES = {"application/json", "application/x-ndjson"}
+
+
+def gzip_compress(body: bytes) -> bytes:
+    # wbits 16 + MAX_WBITS writes the gzip header and trailer
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def deflate_compress(body: bytes) -> bytes:
+    # "deflate" in HTTP means the zlib format, not a raw deflate stream
+    return zlib.compress(body, COMPRESS_LEVEL)
+
+
+def zstd_compress(body: bytes) -> bytes:
+    # compressors aren't thread safe, so each call gets its own
+    return zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compress(body)
+
+
+# in order of preference when the client accepts several with the same q
+encoders: dict[str, Callable[[bytes], bytes]] = {}
+if zstandard is not None:
+    encoders["zstd"] = zstd_compress
+encoders["gzip"] = gzip_compress
+encoders["deflate"] = deflate_compress
+
+
+@lru_cache(maxsize=256)
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    # clients send a handful of distinct headers, so parsing is cached per value
+    weights: dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+
+    best, best_q = None, 0.0
+    for coding in encoders:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def add_vary(resp: StreamResponse):
+    vary = resp.headers.get(hdrs.VARY)
+    if not vary:
+        resp.headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+    elif hdrs.ACCEPT_ENCODING.lower() not in vary.lower():
+        resp.headers[hdrs.VARY] = f"{vary}, {hdrs.ACCEPT_ENCODING}"
+
+
+def weaken_etag(resp: StreamResponse):
+    # the compressed body isn't byte for byte what the strong validator described
+    etag = resp.headers.get(hdrs.ETAG)
+    if etag and not etag.startswith("W/"):
+        resp.headers[hdrs.ETAG] = f"W/{etag}"
+
+
+@middleware
+async def compress_response(request: Request, handler) -> StreamResponse:
+    resp = await handler(request)
+
+    # streamed responses have already sent their headers
+    if not isinstance(resp, Response) or resp.prepared:
+        return resp
+    accept_encoding = request.headers.get(hdrs.ACCEPT_ENCODING)
+    if not accept_encoding or request.method == "HEAD":
+        return resp
+    if not (coding := negotiate_encoding(accept_encoding)):
+        return resp
+
+    # a 304 has to describe the variant the client would have got with a 200
+    if resp.status == 304:
+        weaken_etag(resp)
+        add_vary(resp)
+        return resp
+
+    body = resp.body
+    if (
+        not isinstance(body, (bytes, bytearray))
+        or len(body) < COMPRESS_MIN_SIZE
+        or hdrs.CONTENT_ENCODING in resp.headers
+        or resp.content_type not in COMPRESSIBLE_TYPES
+    ):
+        return resp
+
+    encode = encoders[coding]
+    if len(body) >= COMPRESS_EXECUTOR_SIZE:
+        compressed = await get_running_loop().run_in_executor(None, encode, body)
+    else:
+        compressed = encode(body)
+
+    resp.body = compressed
+    resp.headers[hdrs.CONTENT_ENCODING] = coding
+    weaken_etag(resp)
+    add_vary(resp)
+    return resp
@@ -0,0 +1,19 @@
+from aiohttp.web import Request, Response, middleware
+
+from ..lifecycle import lifecycle
+from ..models import APIResponse
+from ..serialization import json_response
+
+
+@middleware
+async def reject_when_draining(request: Request, handler) -> Response:
+    # requests that arrive on kept-alive connections after shutdown started
+    if lifecycle.draining:
+        return json_response(
+            APIResponse(
+                {"message": "Server is shutting down"}, success=False, error=True
+            ),
+            status=503,
+            headers={"Connection": "close", "Retry-After": "1"},
+        )
+    return await handler(request)
@@ -0,0 +1,37 @@
+from asyncio import CancelledError
+from time import monotonic
+
+from aiohttp.web import HTTPException, Request, StreamResponse, middleware
+
+from ..metrics import counter, histogram
+
+requests_total = counter(
+    "http_requests_total", "Requests handled", ("method", "route", "status")
+)
+request_seconds = histogram(
+    "http_request_seconds", "Time spent handling a request", ("method", "route")
+)
+
+
+@middleware
+async def record_metrics(request: Request, handler) -> StreamResponse:
+    started = monotonic()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except HTTPException as e:
+        status = e.status
+        raise
+    except CancelledError:
+        # the client went away before we answered
+        status = 499
+        raise
+    finally:
+        # labelled by route template rather than path so ids don't blow up the
+        # number of series
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else "unmatched"
+        request_seconds.labels(request.method, route).observe(monotonic() - started)
+        requests_total.labels(request.method, route, status).inc()
@@ -0,0 +1,172 @@
+from math import ceil
+from os import getenv
+from time import monotonic
+from typing import Hashable
+
+from aiohttp.web import Request
+from attr import define
+
+from src.user.metrics import counter, register_collector
+
+# header set by a trusted proxy with the client's address, e.g. X-Real-IP. without
+# it the peer address is used, forwarded headers can't be trusted from clients
+RATE_LIMIT_CLIENT_IP_HEADER = getenv("RATE_LIMIT_CLIENT_IP_HEADER")
+# keys tracked per limiter, once full new keys aren't limited by it
+RATE_LIMIT_MAX_KEYS = int(getenv("RATE_LIMIT_MAX_KEYS", 100_000))
+# seconds covered by one slot of the expiry wheel
+RATE_LIMIT_TICK = 1.0
+
+
+@define
+class RateLimited(Exception):
+    error: str
+    retry_after: float
+
+
+@define
+class Bucket:
+    tokens: float
+    updated: float
+    # when the bucket is full again, from then on it's the same as no bucket
+    expires: float
+
+
+class RateLimiter:
+    # token bucket per key. buckets that have refilled are dropped by a timing
+    # wheel, each sweep only touches the keys that were due in the elapsed slots
+    def __init__(self, name: str, requests: int, period: float):
+        self.name = name
+        self.burst = float(requests)
+        self.rate = requests / period
+        self.buckets: dict[Hashable, Bucket] = {}
+        # an empty bucket refills within period, so one turn of the wheel covers
+        # every possible expiry
+        self.wheel: list[set[Hashable]] = [
+            set() for _ in range(ceil(period / RATE_LIMIT_TICK) + 2)
+        ]
+        # first tick that hasn't been swept yet
+        self.swept: int | None = None
+        self.overflows = 0
+
+    def sweep(self, now: float):
+        current = int(now / RATE_LIMIT_TICK)
+        if self.swept is None:
+            self.swept = current
+        # only slots that are entirely in the past, after a long pause at most one
+        # turn needs to be looked at
+        start = max(self.swept, current - len(self.wheel))
+        for tick in range(start, current):
+            slot = self.wheel[tick % len(self.wheel)]
+            for key in slot:
+                bucket = self.buckets.get(key)
+                # keys that were used again since are also in a later slot
+                if bucket is not None and bucket.expires < now:
+                    del self.buckets[key]
+            slot.clear()
+        self.swept = max(self.swept, current)
+
+    def take(self, key: Hashable, now: float) -> float:
+        # returns 0 if the request is allowed, otherwise seconds until it would be
+        self.sweep(now)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= RATE_LIMIT_MAX_KEYS:
+                self.overflows += 1
+                return 0
+            bucket = self.buckets[key] = Bucket(self.burst, now, now)
+        else:
+            bucket.tokens = min(
+                self.burst, bucket.tokens + (now - bucket.updated) * self.rate
+            )
+            bucket.updated = now
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            retry_after = 0
+        else:
+            retry_after = (1 - bucket.tokens) / self.rate
+
+        bucket.expires = now + (self.burst - bucket.tokens) / self.rate
+        self.wheel[int(bucket.expires / RATE_LIMIT_TICK) % len(self.wheel)].add(key)
+        return retry_after
+
+
+def parse_limit(value: str) -> tuple[int, float]:
+    # "<requests>/<seconds>", e.g. 5/60
+    requests, _, period = value.partition("/")
+    return int(requests), float(period)
+
+
+def limiter(name: str, default: str) -> RateLimiter:
+    # RATE_LIMIT_<NAME>, e.g. RATE_LIMIT_AUTHENTICATE_IP=20/60
+    return RateLimiter(
+        name, *parse_limit(getenv(f"RATE_LIMIT_{name.upper()}", default))
+    )
+
+
+@define
+class RouteLimits:
+    by_ip: RateLimiter
+    by_username: RateLimiter
+
+
+route_limits: dict[str, RouteLimits] = {
+    "authenticate": RouteLimits(
+        limiter("authenticate_ip", "30/60"),
+        limiter("authenticate_username", "10/300"),
+    ),
+    "create_account": RouteLimits(
+        limiter("create_account_ip", "10/3600"),
+        limiter("create_account_username", "5/60"),
+    ),
+}
+
+rejected = counter(
+    "rate_limit_rejected_total", "Requests rejected by a rate limit", ("limit",)
+)
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_CLIENT_IP_HEADER and (
+        ip := request.headers.get(RATE_LIMIT_CLIENT_IP_HEADER)
+    ):
+        return ip.strip()
+    return request.remote or ""
+
+
+def check_rate_limit(route: str, request: Request, username: str):
+    limits = route_limits[route]
+    now = monotonic()
+    for rate_limiter, key in (
+        (limits.by_ip, client_ip(request)),
+        # usernames are matched case insensitively by the database
+        (limits.by_username, username.lower()),
+    ):
+        if retry_after := rate_limiter.take(key, now):
+            rejected.labels(rate_limiter.name).inc()
+            raise RateLimited("Too many attempts, please try again later", retry_after)
+
+
+def collect_rate_limit_metrics():
+    limiters = [
+        rate_limiter
+        for limits in route_limits.values()
+        for rate_limiter in (limits.by_ip, limits.by_username)
+    ]
+    return [
+        (
+            "rate_limit_keys",
+            "Keys with a bucket that hasn't refilled yet",
+            "gauge",
+            [({"limit": rl.name}, len(rl.buckets)) for rl in limiters],
+        ),
+        (
+            "rate_limit_overflows_total",
+            "New keys let through because the limiter was full",
+            "counter",
+            [({"limit": rl.name}, rl.overflows) for rl in limiters],
+        ),
+    ]
+
+
+register_collector(collect_rate_limit_metrics)
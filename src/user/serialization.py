@@ -0,0 +1,43 @@
+from typing import Any
+
+from aiohttp.web import Response
+from cattr import Converter
+from cattr.gen import make_dict_unstructure_fn
+from orjson import dumps
+
+from src.user.models import APIResponse
+from src.user.timing import span
+
+converter = Converter()
+
+
+# only unwraps the envelope, orjson walks the response payload itself and calls
+# back into the converter for the attrs instances it finds
+def unstructure_api_response(resp: APIResponse) -> dict:
+    return {"response": resp.response, "success": resp.success, "error": resp.error}
+
+
+converter.register_unstructure_hook(APIResponse, unstructure_api_response)
+
+
+def precompile_unstructure_hooks(*classes: type):
+    # nested classes should come before the classes that contain them so the
+    # generated functions call the precompiled hooks directly
+    for cl in classes:
+        converter.register_unstructure_hook(cl, make_dict_unstructure_fn(cl, converter))
+
+
+def encode(data: Any) -> bytes:
+    with span("encode"):
+        return dumps(data, default=converter.unstructure)
+
+
+def json_response(
+    data: Any, status: int = 200, headers: dict[str, str] | None = None
+) -> Response:
+    return Response(
+        body=encode(data),
+        status=status,
+        headers=headers,
+        content_type="application/json",
+    )
@@ -1,33 +1,51 @@
 import asyncio
+import os
+import select
+import signal
+import traceback
+from argparse import ArgumentParser, Namespace
 from asyncio import run
 from os import getenv
+from time import monotonic, sleep
 
 import aiohttp_cors
 from aiohttp import web
 from aiohttp_session import setup
-from aiohttp_session.cookie_storage import EncryptedCookieStorage
-from dotenv import load_dotenv
 
-from src.common.upload_s3 import init_s3
-from src.user.db import DbName, create_pool
 from src.user.handlers import routes as app_routes
+from src.user.lifecycle import (
+    DRAIN_DELAY,
+    begin_drain,
+    on_cleanup,
+    on_shutdown,
+    on_startup,
+)
 from src.user.middleware import middlewares
+from src.user.session import CachedEncryptedCookieStorage
+from src.user.tasks.supervisor import TASK_DRAIN_TIMEOUT
 
-load_dotenv()
+# seconds a replacement worker gets to start listening during a rolling restart
+WORKER_START_TIMEOUT = float(getenv("WORKER_START_TIMEOUT", 30))
+# seconds a worker gets to finish in-flight requests after SIGTERM
+WORKER_STOP_TIMEOUT = float(getenv("WORKER_STOP_TIMEOUT", 30))
+# the supervisor only kills a worker once every drain phase had its chance
+WORKER_KILL_TIMEOUT = DRAIN_DELAY + WORKER_STOP_TIMEOUT + TASK_DRAIN_TIMEOUT + 5
+# workers that die sooner than this after starting are respawned with a delay
+WORKER_MIN_UPTIME = float(getenv("WORKER_MIN_UPTIME", 5))
 
 
-async def init():
-    await create_pool(DbName.USER)
-    await create_pool(DbName.FEED)
-
-    init_s3()
-
+async def init(workers: int = 1) -> web.Application:
     cookie_name = "atms_session_id"
 
     app = web.Application(middlewares=middlewares)
+    # pools are opened by on_startup, inside the event loop that serves the app
+    app["workers"] = workers
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
     setup(
         app,
-        EncryptedCookieStorage(
+        CachedEncryptedCookieStorage(
             cookie_name=cookie_name,
             secret_key=getenv("COOKIE_KEY"),
             domain=".atmospheretest.site",
@@ -48,8 +66,168 @@ async def init():
     for route in list(app.router.routes()):
         cors.add(route)
 
-    await asyncio.gather(web._run_app(app))
+    return app
+
+
+async def serve(args: Namespace, ready_fd: int | None = None):
+    app = await init(args.workers)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # with several workers each one binds its own socket on the same port and
+    # the kernel load balances new connections between them
+    site = web.TCPSite(
+        runner,
+        args.host,
+        args.port,
+        shutdown_timeout=WORKER_STOP_TIMEOUT,
+        reuse_port=args.workers > 1,
+    )
+    await site.start()
+    print(f"Worker {os.getpid()} listening on {args.host}:{args.port}")
+
+    if ready_fd is not None:
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # stop reporting ready, then close the listener, let in-flight requests finish,
+    # flush background work and close the pools
+    await begin_drain()
+    await runner.cleanup()
+
+
+def spawn_worker(args: Namespace, notify: bool = False) -> tuple[int, int | None]:
+    # with notify the worker writes a byte to the returned pipe once it's listening
+    read_fd, write_fd = os.pipe() if notify else (None, None)
+    pid = os.fork()
+    if pid == 0:
+        if read_fd is not None:
+            os.close(read_fd)
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_DFL)
+        code = 0
+        try:
+            run(serve(args, write_fd))
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        os._exit(code)
+
+    if write_fd is not None:
+        os.close(write_fd)
+    return pid, read_fd
+
+
+def wait_ready(read_fd: int, timeout: float) -> bool:
+    readable, _, _ = select.select([read_fd], [], [], timeout)
+    ready = bool(readable) and os.read(read_fd, 1) == b"1"
+    os.close(read_fd)
+    return ready
+
+
+def stop_worker(pid: int, timeout: float) -> int | None:
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return None
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return status
+        sleep(0.1)
+    os.kill(pid, signal.SIGKILL)
+    return os.waitpid(pid, 0)[1]
+
+
+def stop_requested(requested: list[int]) -> bool:
+    return signal.SIGINT in requested or signal.SIGTERM in requested
+
+
+def rolling_restart(args: Namespace, started: dict[int, float], requested: list[int]):
+    for old_pid in list(started):
+        if stop_requested(requested):
+            return
+        pid, read_fd = spawn_worker(args, notify=True)
+        ready = wait_ready(read_fd, WORKER_START_TIMEOUT)
+        if not ready or stop_requested(requested):
+            # the old worker keeps serving. the new one goes, with both the process
+            # would run more workers than configured and go over the DB budget
+            if not ready:
+                print(f"Worker {pid} did not start, aborting rolling restart")
+            stop_worker(pid, WORKER_KILL_TIMEOUT)
+            return
+        started[pid] = monotonic()
+        stop_worker(old_pid, WORKER_KILL_TIMEOUT)
+        del started[old_pid]
+
+
+def supervise(args: Namespace):
+    # SIGTERM/SIGINT stop every worker gracefully, SIGHUP replaces them one at a time
+    requested: list[int] = []
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, lambda signum, frame: requested.append(signum))
+
+    started: dict[int, float] = {}
+    for _ in range(args.workers):
+        pid, _ = spawn_worker(args)
+        started[pid] = monotonic()
+
+    while started:
+        if stop_requested(requested):
+            for pid in list(started):
+                os.kill(pid, signal.SIGTERM)
+            for pid in list(started):
+                stop_worker(pid, WORKER_KILL_TIMEOUT)
+                del started[pid]
+            break
+
+        if signal.SIGHUP in requested:
+            # only the SIGHUPs, a SIGTERM that came in with them still stops us.
+            # more than one before the restart starts is handled as one
+            while signal.SIGHUP in requested:
+                requested.remove(signal.SIGHUP)
+            rolling_restart(args, started, requested)
+            continue
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if not pid:
+            sleep(0.2)
+            continue
+
+        uptime = monotonic() - started.pop(pid, monotonic())
+        print(f"Worker {pid} exited with status {status}, respawning")
+        if uptime < WORKER_MIN_UPTIME:
+            # don't spin if workers crash on startup, e.g. the DB is down
+            sleep(WORKER_MIN_UPTIME)
+        pid, _ = spawn_worker(args)
+        started[pid] = monotonic()
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument("--host", default=getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(getenv("PORT", 8080)))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(getenv("WORKERS", 1)),
+        help="number of worker processes sharing the port via SO_REUSEPORT",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    run(init())
+    args = parse_args()
+    if args.workers > 1:
+        supervise(args)
+    else:
+        run(serve(args))
@@ -0,0 +1,59 @@
+from hashlib import blake2b
+from os import getenv
+
+from aiohttp.web import Request
+from aiohttp_session import Session, get_session
+from aiohttp_session.cookie_storage import EncryptedCookieStorage
+from cryptography.fernet import InvalidToken
+
+from src.user.cache import LRUCache
+from src.user.db import request_user_id
+from src.user.models import UserSession
+from src.user.timing import span
+
+SESSION_CACHE_SIZE = int(getenv("SESSION_CACHE_SIZE", 4096))
+SESSION_CACHE_TTL = float(getenv("SESSION_CACHE_TTL", 300))
+
+USER_SESSION_KEY = "session"
+
+
+# memoizes decrypted cookies so repeat requests from the same client skip the
+# Fernet decrypt and JSON parse. keys are a hash of the cookie, not the cookie
+class CachedEncryptedCookieStorage(EncryptedCookieStorage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.decrypted: LRUCache[bytes, dict] = LRUCache(
+            SESSION_CACHE_SIZE, SESSION_CACHE_TTL, "session"
+        )
+
+    async def load_session(self, request: Request) -> Session:
+        cookie = self.load_cookie(request)
+        if cookie is None:
+            return Session(None, data=None, new=True, max_age=self.max_age)
+
+        key = blake2b(cookie.encode("utf-8"), digest_size=16).digest()
+        # Session copies the data into its own mapping, so the cached dict is never mutated
+        if (data := self.decrypted.get(key)) is None:
+            try:
+                data = self._decoder(
+                    self._fernet.decrypt(
+                        cookie.encode("utf-8"), ttl=self.max_age
+                    ).decode("utf-8")
+                )
+            except InvalidToken:
+                return Session(None, data=None, new=True, max_age=self.max_age)
+            self.decrypted.set(key, data)
+        return Session(None, data=data, new=False, max_age=self.max_age)
+
+
+async def get_user_session(request: Request) -> UserSession | None:
+    # the cookie is only loaded the first time a request asks for the session
+    if USER_SESSION_KEY not in request:
+        user_session = None
+        with span("session"):
+            sess = await get_session(request)
+        if user_id := sess.get("user_id"):
+            user_session = UserSession(user_id, sess.get("username"))
+            request_user_id.set(user_id)
+        request[USER_SESSION_KEY] = user_session
+    return request[USER_SESSION_KEY]
@@ -0,0 +1,25 @@
+from os import getenv
+
+from src.user.db import Transaction
+
+# "delta" applies +1/-1 to counters as rows change, "recount" recomputes them
+COUNTER_MODE = getenv("COUNTER_MODE", "delta")
+
+
+async def apply_count_delta(
+    tx: Transaction, table: str, id_column: str, row_id: int, column: str, delta: int
+):
+    if delta >= 0:
+        query = (
+            f"update `{table}` set `{column}` = `{column}` + %s "
+            f"where `{id_column}` = %s"
+        )
+        values = (delta, row_id)
+    else:
+        # guarded so an already drifted counter can't underflow
+        query = (
+            f"update `{table}` set `{column}` = `{column}` - %s "
+            f"where `{id_column}` = %s and `{column}` >= %s"
+        )
+        values = (-delta, row_id, -delta)
+    await tx.update(query, values)
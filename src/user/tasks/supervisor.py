@@ -0,0 +1,281 @@
+import asyncio
+import traceback
+from contextlib import asynccontextmanager
+from os import getenv
+from time import monotonic
+from typing import Any, Awaitable, Callable, Hashable
+
+from attr import Factory, define
+
+from src.user.metrics import register_collector
+
+TASK_RETRY_BASE_DELAY = float(getenv("TASK_RETRY_BASE_DELAY", 0.5))
+TASK_RETRY_MAX_DELAY = float(getenv("TASK_RETRY_MAX_DELAY", 10))
+TASK_DRAIN_TIMEOUT = float(getenv("TASK_DRAIN_TIMEOUT", 10))
+
+
+@define
+class TaskStats:
+    submitted: int = 0
+    deduplicated: int = 0
+    dropped: int = 0
+    completed: int = 0
+    retried: int = 0
+    failed: int = 0
+    latency_total: float = 0.0
+    latency_max: float = 0.0
+
+
+@define
+class KeyLock:
+    lock: asyncio.Lock = Factory(asyncio.Lock)
+    # workers running or waiting to run a job with the key
+    users: int = 0
+
+
+@define
+class TaskType:
+    name: str
+    fn: Callable[..., Awaitable[Any]]
+    workers: int
+    max_queue: int
+    retries: int
+    queue: asyncio.Queue | None = None
+    # dedupe keys of jobs that are queued but haven't started yet
+    pending: set[Hashable] = Factory(set)
+    # jobs with the same key run one at a time, in the order they were queued
+    key_locks: dict[Hashable, KeyLock] = Factory(dict)
+    worker_tasks: list[asyncio.Task] = Factory(list)
+    stats: TaskStats = Factory(TaskStats)
+
+
+task_types: dict[str, TaskType] = {}
+
+
+def register_task(
+    name: str,
+    fn: Callable[..., Awaitable[Any]],
+    workers: int = 2,
+    max_queue: int = 1000,
+    retries: int = 3,
+):
+    # TASK_<NAME>_WORKERS / TASK_<NAME>_QUEUE / TASK_<NAME>_RETRIES override the defaults
+    prefix = f"TASK_{name.upper()}_"
+    task_types[name] = TaskType(
+        name,
+        fn,
+        workers=int(getenv(f"{prefix}WORKERS", workers)),
+        max_queue=int(getenv(f"{prefix}QUEUE", max_queue)),
+        retries=int(getenv(f"{prefix}RETRIES", retries)),
+    )
+
+
+def get_task_type(name: str) -> TaskType:
+    task_type = task_types[name]
+    if task_type.queue is None:
+        task_type.queue = asyncio.Queue(task_type.max_queue)
+    return task_type
+
+
+def submit(name: str, *args, key: Hashable | None = None) -> bool:
+    task_type = get_task_type(name)
+    if key is not None:
+        if key in task_type.pending:
+            task_type.stats.deduplicated += 1
+            return True
+
+    try:
+        task_type.queue.put_nowait((key, args, monotonic()))
+    except asyncio.QueueFull:
+        task_type.stats.dropped += 1
+        return False
+
+    if key is not None:
+        task_type.pending.add(key)
+    task_type.stats.submitted += 1
+    return True
+
+
+async def submit_wait(name: str, *args, key: Hashable | None = None):
+    # for jobs that can't be dropped, waits for room in the queue instead. the
+    # put is shielded so a cancelled request still queues its job
+    task_type = get_task_type(name)
+    if key is not None:
+        if key in task_type.pending:
+            task_type.stats.deduplicated += 1
+            return
+        task_type.pending.add(key)
+    task_type.stats.submitted += 1
+    await asyncio.shield(task_type.queue.put((key, args, monotonic())))
+
+
+@asynccontextmanager
+async def key_serialized(task_type: TaskType, key: Hashable | None):
+    if key is None:
+        yield
+        return
+    key_lock = task_type.key_locks.get(key)
+    if key_lock is None:
+        key_lock = task_type.key_locks[key] = KeyLock()
+    key_lock.users += 1
+    try:
+        async with key_lock.lock:
+            yield
+    finally:
+        key_lock.users -= 1
+        if not key_lock.users:
+            del task_type.key_locks[key]
+
+
+async def run_job(task_type: TaskType, args: tuple):
+    for attempt in range(task_type.retries + 1):
+        try:
+            await task_type.fn(*args)
+            return True
+        except Exception:
+            if attempt == task_type.retries:
+                traceback.print_exc()
+                return False
+            task_type.stats.retried += 1
+            await asyncio.sleep(
+                min(TASK_RETRY_BASE_DELAY * 2**attempt, TASK_RETRY_MAX_DELAY)
+            )
+
+
+async def worker(task_type: TaskType):
+    while True:
+        key, args, enqueued_at = await task_type.queue.get()
+        # from here on a new submission for the same key needs its own run
+        task_type.pending.discard(key)
+        try:
+            async with key_serialized(task_type, key):
+                succeeded = await run_job(task_type, args)
+            if succeeded:
+                task_type.stats.completed += 1
+            else:
+                task_type.stats.failed += 1
+            latency = monotonic() - enqueued_at
+            task_type.stats.latency_total += latency
+            task_type.stats.latency_max = max(task_type.stats.latency_max, latency)
+        finally:
+            task_type.queue.task_done()
+
+
+def start_tasks():
+    for task_type in task_types.values():
+        if task_type.queue is None:
+            task_type.queue = asyncio.Queue(task_type.max_queue)
+        if not task_type.worker_tasks:
+            task_type.worker_tasks = [
+                asyncio.create_task(worker(task_type)) for _ in range(task_type.workers)
+            ]
+
+
+async def drain_tasks(timeout: float = TASK_DRAIN_TIMEOUT):
+    running = [
+        task_type
+        for task_type in task_types.values()
+        if task_type.queue is not None and task_type.worker_tasks
+    ]
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(task_type.queue.join() for task_type in running)),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        for task_type in running:
+            if dropped := task_type.queue.qsize():
+                print(
+                    f"Task queue {task_type.name} not drained, {dropped} jobs dropped"
+                )
+
+    for task_type in running:
+        for worker_task in task_type.worker_tasks:
+            worker_task.cancel()
+        await asyncio.gather(*task_type.worker_tasks, return_exceptions=True)
+        task_type.worker_tasks = []
+
+
+def get_task_stats() -> dict[str, dict]:
+    stats = {}
+    for name, task_type in task_types.items():
+        task_stats = task_type.stats
+        finished = task_stats.completed + task_stats.failed
+        stats[name] = {
+            "workers": len(task_type.worker_tasks),
+            "queue_depth": task_type.queue.qsize() if task_type.queue else 0,
+            "max_queue": task_type.max_queue,
+            "submitted": task_stats.submitted,
+            "deduplicated": task_stats.deduplicated,
+            "dropped": task_stats.dropped,
+            "completed": task_stats.completed,
+            "retried": task_stats.retried,
+            "failed": task_stats.failed,
+            "latency_total": task_stats.latency_total,
+            "latency_avg": task_stats.latency_total / finished if finished else 0.0,
+            "latency_max": task_stats.latency_max,
+        }
+    return stats
+
+
+def collect_task_metrics():
+    stats = get_task_stats()
+
+    def samples(key: str) -> list:
+        return [({"task": name}, task_stat[key]) for name, task_stat in stats.items()]
+
+    return [
+        (
+            "task_queue_depth",
+            "Jobs waiting in the queue",
+            "gauge",
+            samples("queue_depth"),
+        ),
+        ("task_queue_max", "Queue capacity", "gauge", samples("max_queue")),
+        (
+            "task_submitted_total",
+            "Jobs queued",
+            "counter",
+            samples("submitted"),
+        ),
+        (
+            "task_deduplicated_total",
+            "Jobs skipped because the same key was already queued",
+            "counter",
+            samples("deduplicated"),
+        ),
+        (
+            "task_dropped_total",
+            "Jobs dropped on a full queue",
+            "counter",
+            samples("dropped"),
+        ),
+        (
+            "task_completed_total",
+            "Jobs that succeeded",
+            "counter",
+            samples("completed"),
+        ),
+        (
+            "task_failed_total",
+            "Jobs that ran out of retries",
+            "counter",
+            samples("failed"),
+        ),
+        ("task_retried_total", "Job retries", "counter", samples("retried")),
+        (
+            "task_latency_seconds_total",
+            "Seconds from queueing to finishing, summed over finished jobs",
+            "counter",
+            samples("latency_total"),
+        ),
+        (
+            "task_latency_seconds_max",
+            "Longest time from queueing to finishing",
+            "gauge",
+            samples("latency_max"),
+        ),
+    ]
+
+
+register_collector(collect_task_metrics)
@@ -1,4 +1,7 @@
-from src.user.db import DbName, select_one, update
+from src.user.db import DbName, Transaction, select_one, transaction, update
+from src.user.db_user import invalidate_profile
+from src.user.tasks import apply_count_delta
+from src.user.tasks.supervisor import register_task
 
 
 async def update_follower_count(user_id: int):
@@ -6,6 +9,7 @@ async def update_follower_count(user_id: int):
         DbName.FEED,
         "select count(1) from following where following_id = %s",
         (user_id,),
+        primary=True,
     )
 
     num_followers = count_followers[0] if count_followers else 0
@@ -18,3 +22,42 @@ async def update_follower_count(user_id: int):
             user_id,
         ),
     )
+    invalidate_profile(user_id)
+
+
+async def update_following_count(user_id: int):
+    count_following = await select_one(
+        DbName.FEED,
+        "select count(1) from following where follower_id = %s",
+        (user_id,),
+        primary=True,
+    )
+
+    num_following = count_following[0] if count_following else 0
+
+    await update(
+        DbName.USER,
+        "update `profile` set `following_count` = %s where `user_id` = %s",
+        (
+            num_following,
+            user_id,
+        ),
+    )
+    invalidate_profile(user_id)
+
+
+async def apply_profile_count_delta(
+    tx: Transaction, column: str, user_id: int, delta: int
+):
+    await apply_count_delta(tx, "profile", "user_id", user_id, column, delta)
+    tx.after_commit(invalidate_profile, user_id)
+
+
+async def apply_follow_delta(follower_id: int, following_id: int, delta: int):
+    async with transaction(DbName.USER) as tx:
+        await apply_profile_count_delta(tx, "follower_count", following_id, delta)
+        await apply_profile_count_delta(tx, "following_count", follower_id, delta)
+
+
+register_task("follower_count", update_follower_count)
+register_task("following_count", update_following_count)
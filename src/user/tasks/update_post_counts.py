@@ -1,38 +1,97 @@
-from src.user.db import DbName, select_one, update
+import asyncio
+import traceback
+from os import getenv
 
+from src.user.db import DbName, Transaction, update
+from src.user.tasks import apply_count_delta
 
-async def update_post_comment_count(post_id: int):
-    count_comments = await select_one(
-        DbName.FEED,
-        "select count(1) from post_comment where post_id = %s",
-        (post_id,),
-    )
+POST_COUNT_FLUSH_INTERVAL = float(getenv("POST_COUNT_FLUSH_INTERVAL", 1))
+POST_COUNT_FLUSH_BATCH = int(getenv("POST_COUNT_FLUSH_BATCH", 500))
 
-    num_comments = count_comments[0] if count_comments else 0
+# post ids whose counters need to be recounted on the next flush
+dirty_like_counts: set[int] = set()
+dirty_comment_counts: set[int] = set()
 
-    await update(
-        DbName.FEED,
-        "update `post` set `num_comments` = %s where `post_id` = %s",
-        (
-            num_comments,
-            post_id,
-        ),
-    )
+flusher: asyncio.Task | None = None
+
+
+def mark_post_like_count_dirty(post_id: int):
+    dirty_like_counts.add(post_id)
 
 
-async def update_post_like_count(post_id: int):
-    count_likes = await select_one(
+def mark_post_comment_count_dirty(post_id: int):
+    dirty_comment_counts.add(post_id)
+
+
+async def update_post_comment_counts(post_ids: list[int]):
+    post_ids_string = ",".join(["%s"] * len(post_ids))
+    await update(
         DbName.FEED,
-        "select count(1) from post_like where post_id = %s",
-        (post_id,),
+        "update `post` set `num_comments` = (select count(1) from `post_comment` where "
+        f"`post_comment`.`post_id` = `post`.`post_id`) where `post_id` in ({post_ids_string})",
+        tuple(post_ids),
     )
 
-    num_likes = count_likes[0] if count_likes else 0
+
+async def update_post_like_counts(post_ids: list[int]):
+    post_ids_string = ",".join(["%s"] * len(post_ids))
     await update(
         DbName.FEED,
-        "update `post` set `num_likes` = %s where `post_id` = %s",
-        (
-            num_likes,
-            post_id,
-        ),
+        "update `post` set `num_likes` = (select count(1) from `post_like` where "
+        f"`post_like`.`post_id` = `post`.`post_id`) where `post_id` in ({post_ids_string})",
+        tuple(post_ids),
     )
+
+
+async def apply_post_like_delta(tx: Transaction, post_id: int, delta: int):
+    await apply_count_delta(tx, "post", "post_id", post_id, "num_likes", delta)
+
+
+async def apply_post_comment_delta(tx: Transaction, post_id: int, delta: int):
+    await apply_count_delta(tx, "post", "post_id", post_id, "num_comments", delta)
+
+
+async def flush_dirty(dirty: set[int], update_counts):
+    post_ids = list(dirty)
+    dirty.clear()
+    for i in range(0, len(post_ids), POST_COUNT_FLUSH_BATCH):
+        chunk = post_ids[i : i + POST_COUNT_FLUSH_BATCH]
+        try:
+            await update_counts(chunk)
+        except asyncio.CancelledError:
+            dirty.update(post_ids[i:])
+            raise
+        except Exception:
+            traceback.print_exc()
+            # retry on the next flush
+            dirty.update(chunk)
+
+
+async def flush_post_counts():
+    await flush_dirty(dirty_like_counts, update_post_like_counts)
+    await flush_dirty(dirty_comment_counts, update_post_comment_counts)
+
+
+async def run_post_count_flusher():
+    while True:
+        await asyncio.sleep(POST_COUNT_FLUSH_INTERVAL)
+        await flush_post_counts()
+
+
+def start_post_count_flusher():
+    global flusher
+    if flusher is None:
+        flusher = asyncio.create_task(run_post_count_flusher())
+
+
+async def stop_post_count_flusher():
+    global flusher
+    if flusher is not None:
+        flusher.cancel()
+        try:
+            await flusher
+        except asyncio.CancelledError:
+            pass
+        flusher = None
+    # whatever is still dirty gets written before shutdown
+    await flush_post_counts()
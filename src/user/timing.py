@@ -0,0 +1,119 @@
+import asyncio
+import os
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from cProfile import Profile
+from itertools import count
+from os import getenv
+from time import perf_counter, time
+
+from attr import Factory, define
+
+# adds a Server-Timing header with the spans below to every api response
+SERVER_TIMING = getenv("SERVER_TIMING", "0") == "1"
+# seconds, requests slower than this log their spans. 0 disables the log
+SLOW_REQUEST_THRESHOLD = float(getenv("SLOW_REQUEST_THRESHOLD", 0))
+# route template to profile, e.g. /user/{id}/posts, and how many of its requests
+# share one profile
+PROFILE_ROUTE = getenv("PROFILE_ROUTE")
+PROFILE_SAMPLE_RATE = int(getenv("PROFILE_SAMPLE_RATE", 100))
+PROFILE_DIR = getenv("PROFILE_DIR", "profiles")
+
+
+@define
+class Timings:
+    started: float
+    # span name -> [seconds, count], spans with the same name are summed
+    spans: dict[str, list] = Factory(dict)
+
+    def add(self, name: str, seconds: float):
+        if (span_total := self.spans.get(name)) is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            span_total[0] += seconds
+            span_total[1] += 1
+
+    def total(self) -> float:
+        return perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        parts = [
+            f'{name};dur={seconds * 1000:.2f};desc="{calls}x"'
+            for name, (seconds, calls) in self.spans.items()
+        ]
+        parts.append(f"total;dur={self.total() * 1000:.2f}")
+        return ", ".join(parts)
+
+    def describe(self) -> str:
+        return " ".join(
+            f"{name}={seconds * 1000:.1f}ms/{calls}"
+            for name, (seconds, calls) in self.spans.items()
+        )
+
+
+# set by the api_response wrapper for the duration of a request
+request_timings: ContextVar[Timings | None] = ContextVar(
+    "request_timings", default=None
+)
+
+timing_enabled = SERVER_TIMING or SLOW_REQUEST_THRESHOLD > 0
+
+
+def add_span(name: str, seconds: float):
+    if (timings := request_timings.get()) is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def span(name: str):
+    if (timings := request_timings.get()) is None:
+        yield
+        return
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, perf_counter() - started)
+
+
+# only one profiler can be enabled at a time, across every route and method
+profiling = False
+
+
+class RouteProfiler:
+    # cProfile sees every coroutine that runs on the loop while it's enabled, so
+    # a sample includes whatever other requests were doing at the same time
+    def __init__(self, method: str, path: str):
+        self.name = re.sub(r"\W+", "_", f"{method} {path}").strip("_")
+        self.requests = count()
+
+    def start(self) -> Profile | None:
+        global profiling
+        if next(self.requests) % PROFILE_SAMPLE_RATE or profiling:
+            return None
+        profiling = True
+        profiler = Profile()
+        profiler.enable()
+        return profiler
+
+    def finish(self, profiler: Profile):
+        global profiling
+        profiler.disable()
+        profiling = False
+        # writing the stats is file io and can take a while for a big profile
+        asyncio.get_running_loop().run_in_executor(None, self.write, profiler)
+
+    def write(self, profiler: Profile):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(
+            PROFILE_DIR, f"{self.name}-{int(time() * 1000)}-{os.getpid()}.prof"
+        )
+        profiler.dump_stats(path)
+        print(f"Wrote profile {path}")
+
+
+def route_profiler(method: str, path: str) -> RouteProfiler | None:
+    if PROFILE_ROUTE and PROFILE_ROUTE == path:
+        return RouteProfiler(method, path)
+    return None
@@ -1,10 +1,11 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
 from re import compile, fullmatch
+from string import ascii_letters, ascii_lowercase, digits
+from typing import Callable, Optional
 
 from aiohttp.web import Request
 from attr import define
-from cattr import structure
-from cattr.errors import ClassValidationError
-from orjson import loads
 
 BIO_MAX_CHARS = 255
 DISPLAY_NAME_MAX_CHARS = 30
@@ -19,6 +20,15 @@ EMAIL_REGEX = compile(
     r"^[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*@(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?$"
 )
 
+# the regexes above define the accepted languages, they're matched by the
+# automata below instead. in the username regex !, . and * are both separators
+# and body characters so it backtracks exponentially on e.g. "a!!!...!#"
+ALNUM_CHARS = frozenset(ascii_letters + digits)
+USERNAME_BODY_CHARS = ALNUM_CHARS | frozenset("!.*")
+USERNAME_SEPARATOR_CHARS = frozenset(" ;*.!_-")
+EMAIL_LOCAL_CHARS = frozenset(ascii_lowercase + digits + "!#$%&'*+/=?^_`{|}~-")
+EMAIL_DOMAIN_CHARS = frozenset(ascii_lowercase + digits + "-")
+
 UPLOAD_URL_KEY_REGEX = compile(r"([A-Za-z0-9\-_=/.])+(png|jpg|gif|jpeg|webp)")
 
 POST_TEXT_MIN_CHARS = 1
@@ -26,36 +36,136 @@ POST_TEXT_MAX_CHARS = 1000
 COMMENT_TEXT_MIN_CHARS = 2
 COMMENT_TEXT_MAX_CHARS = 300
 
+BULK_MAX_IDS = 100
+
 
 @define
 class InvalidRequest(Exception):
-    pass
+    error: str = "Invalid request"
+    status: int = 400
+
+
+# attrs validators for request classes, they run while the body is structured
+def validate_length(min_chars: int, max_chars: int, message: str):
+    def validate(instance, attribute, value: str):
+        if not (min_chars <= len(value) <= max_chars):
+            raise InvalidRequest(message)
+
+    return validate
+
+
+def validate_with(is_valid: Callable[[str], bool], message: str):
+    def validate(instance, attribute, value: str):
+        if not is_valid(value):
+            raise InvalidRequest(message)
+
+    return validate
+
+
+def encode_cursor(date: int, row_id: int) -> str:
+    return urlsafe_b64encode(f"{date}:{row_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[int, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        date, row_id = urlsafe_b64decode(padded).decode().split(":")
+        return int(date), int(row_id)
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        raise InvalidRequest()
 
 
-async def structure_request_body(request: Request, cl_type):
-    req_json = await request.json(loads=loads)
-    req = None
+def get_page_params(
+    request: Request, default_limit: int, max_limit: int
+) -> tuple[Optional[tuple[int, int]], int]:
+    cursor = request.query.get("cursor")
     try:
-        req = structure(req_json, cl_type)
-    except ClassValidationError:
+        limit = int(request.query.get("limit", default_limit))
+    except ValueError:
+        raise InvalidRequest()
+    return (
+        decode_cursor(cursor) if cursor else None,
+        max(1, min(limit, max_limit)),
+    )
+
+
+def get_query_list(
+    request: Request, name: str, max_items: int = BULK_MAX_IDS
+) -> list[str]:
+    value = request.query.get(name)
+    if not value:
+        return []
+    # de-duplicated, in request order
+    items = list(dict.fromkeys(item for item in value.split(",") if item))
+    if len(items) > max_items:
         raise InvalidRequest()
-    except Exception as e:
-        print(e)
-    if not req:
-        print("NO")
-    return req
+    return items
+
+
+def get_query_ids(
+    request: Request, name: str, max_items: int = BULK_MAX_IDS
+) -> list[int]:
+    try:
+        return list(
+            dict.fromkeys(
+                int(item) for item in get_query_list(request, name, max_items)
+            )
+        )
+    except ValueError:
+        raise InvalidRequest()
+
+
+def username_matches(username: str) -> bool:
+    # same as fullmatch(USERNAME_REGEX, username), as a DFA in one pass. the
+    # states are after alphanumerics only, after a separator, and in the body
+    # that follows one, where !, . and * both continue the body and may start a
+    # new separator
+    if not username or username[0] not in ALNUM_CHARS:
+        return False
+    state = "alnum"
+    for char in username:
+        if state == "alnum":
+            if char in ALNUM_CHARS:
+                continue
+            if char not in USERNAME_SEPARATOR_CHARS:
+                return False
+            state = "separator"
+        elif char in USERNAME_BODY_CHARS:
+            state = "body"
+        elif state == "body" and char in USERNAME_SEPARATOR_CHARS:
+            state = "separator"
+        else:
+            return False
+    return state != "separator"
+
+
+def email_matches(email: str) -> bool:
+    # same as fullmatch(EMAIL_REGEX, email). neither character class has "@",
+    # so there's exactly one, with dot separated atoms before it and at least
+    # two dot separated labels after it that don't start or end with "-"
+    local, _, domain = email.partition("@")
+    if not EMAIL_LOCAL_CHARS.issuperset(local.replace(".", "")):
+        return False
+    if not EMAIL_DOMAIN_CHARS.issuperset(domain.replace(".", "")):
+        return False
+    # no empty atoms or labels, which also rules out an empty local part
+    if local[:1] in ("", ".") or local[-1] == "." or ".." in local:
+        return False
+    if domain[:1] in ("", ".", "-") or domain[-1] in ".-" or ".." in domain:
+        return False
+    return "." in domain and ".-" not in domain and "-." not in domain
 
 
 def is_email_valid(email: str) -> bool:
     if not (EMAIL_MIN_CHARS <= len(email) <= EMAIL_MAX_CHARS):
         return False
-    return fullmatch(EMAIL_REGEX, email) is not None
+    return email_matches(email)
 
 
 def is_username_valid(username: str) -> bool:
     if not (USERNAME_MIN_CHARS <= len(username) <= USERNAME_MAX_CHARS):
         return False
-    return fullmatch(USERNAME_REGEX, username) is not None
+    return username_matches(username)
 
 
 def is_upload_url_key_valid(key: str) -> bool:
@@ -0,0 +1,56 @@
+import pytest
+from orjson import dumps
+
+import src.user.handlers  # noqa: F401, registers the precompiled hooks
+from src.user.decoding import decode_request
+from src.user.handlers.auth import AuthenticateRequest, CreateAccountRequest
+from src.user.handlers.models.feed import (
+    CreateCommentRequest,
+    CreatePostRequest,
+    UploadImageRequest,
+)
+from src.user.util import InvalidRequest
+
+VALID_BODIES = {
+    AuthenticateRequest: {"username": "user1", "password": "hunter2hunter2"},
+    CreateAccountRequest: {
+        "username": "new.user_1",
+        "password": "hunter2hunter2",
+        "email": "new.user@example.com",
+    },
+    CreatePostRequest: {"text": "hello"},
+    CreateCommentRequest: {"text": "hello"},
+}
+
+STRING_FIELDS = [
+    (AuthenticateRequest, "username"),
+    (AuthenticateRequest, "password"),
+    (CreateAccountRequest, "username"),
+    (CreateAccountRequest, "password"),
+    (CreatePostRequest, "text"),
+    (CreateCommentRequest, "text"),
+]
+
+
+@pytest.mark.parametrize("cl_type, name", STRING_FIELDS)
+@pytest.mark.parametrize("value", [None, 5, 1.5, True, [1], {"a": "b"}])
+def test_non_string_field_is_rejected(cl_type, name, value):
+    body = dumps({**VALID_BODIES[cl_type], name: value})
+    with pytest.raises(InvalidRequest) as e:
+        decode_request(body, cl_type)
+    assert e.value.status == 400
+
+
+@pytest.mark.parametrize("cl_type", list(VALID_BODIES))
+def test_valid_body_decodes(cl_type):
+    data = VALID_BODIES[cl_type]
+    assert decode_request(dumps(data), cl_type) == cl_type(**data)
+
+
+def test_str_enum_decodes_members_only():
+    decoded = decode_request(b'{"image_type": "png"}', UploadImageRequest)
+    assert decoded.image_type is UploadImageRequest.ImageTypes.PNG
+    for body in (b'{"image_type": "bmp"}', b'{"image_type": 1}'):
+        with pytest.raises(InvalidRequest) as e:
+            decode_request(body, UploadImageRequest)
+        assert e.value.status == 400
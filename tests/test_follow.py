@@ -0,0 +1,40 @@
+import asyncio
+from unittest.mock import ANY
+
+from src.user import db_feed
+from src.user.tasks import supervisor
+
+
+def test_follow_cancelled_on_full_queue_still_applies_counters(monkeypatch):
+    applied = []
+
+    async def insert_one(*args, **kwargs):
+        pass
+
+    async def apply_follow_delta(follower_id, following_id, delta):
+        applied.append((follower_id, following_id, delta))
+
+    monkeypatch.setattr(db_feed, "insert_one", insert_one)
+    monkeypatch.setattr(db_feed, "apply_follow_delta", apply_follow_delta)
+    monkeypatch.setattr(db_feed, "COUNTER_MODE", "delta")
+
+    async def run():
+        task_type = supervisor.task_types["timeline_follow"]
+        monkeypatch.setattr(task_type, "queue", asyncio.Queue(1))
+        monkeypatch.setattr(task_type, "pending", set())
+        task_type.queue.put_nowait((None, (), 0))
+
+        follow = asyncio.create_task(db_feed.follow_user(1, 2))
+        await asyncio.sleep(0.01)
+        assert not follow.done()
+        follow.cancel()
+        await asyncio.gather(follow, return_exceptions=True)
+        assert follow.cancelled()
+        assert applied == [(1, 2, 1)]
+
+        # the job is still queued once there's room
+        task_type.queue.get_nowait()
+        await asyncio.sleep(0.01)
+        assert task_type.queue.get_nowait() == ((1, 2), (1, 2), ANY)
+
+    asyncio.run(run())